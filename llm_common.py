@@ -0,0 +1,239 @@
+"""
+Shared pieces of all natural-language query interfaces, SQLite and DuckDB alike
+(natural_query.py, natural_query_sample.py, natural_query_duckdb.py, natural_query_sample_duckdb.py):
+the Ollama calls, SQL extraction from the model's output, the SQL cache, and the answers.
+Nothing here depends on the database engine.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+from functools import lru_cache
+from ollama import AsyncClient
+
+# Use 127.0.0.1 to avoid localhost resolution issues on Windows.
+# run_batch() sends its requests concurrently; start the server with e.g.
+# OLLAMA_NUM_PARALLEL=8 OLLAMA_MAX_LOADED_MODELS=2 so they are decoded in parallel.
+OLLAMA_HOST = "http://127.0.0.1:11434"
+# Keep models loaded between questions (Ollama unloads after 5 minutes by default)
+KEEP_ALIVE = "30m"
+
+# SQL generation is streamed and cut off as soon as the statement is complete.
+# The server stops at the first ';' (or an invented follow-up question); num_predict bounds runaway output.
+SQL_OPTIONS = {"temperature": 0, "num_predict": 256, "stop": [";", "Question:"]}
+# General models are constrained to {"sql": "..."} (Ollama structured outputs), so they can't emit
+# prose or code fences; the grammar ends the output, so no stop sequences or early cut-off are needed.
+SQL_FORMAT = {"type": "object", "properties": {"sql": {"type": "string"}}, "required": ["sql"]}
+SQL_FORMAT_OPTIONS = {"temperature": 0, "num_predict": 256}
+# Generated SQL is kept across runs, keyed by model, normalized question and schema
+SQL_CACHE_FILE = "sql_cache.sqlite"
+# Print progress messages for every stage; otherwise only the SQL and one timing line are shown
+VERBOSE = False
+# Short results (in rows) only need a one-sentence answer
+SMALL_RESULT_ROWS = 5
+# Static system prompt for the answer step (see build_sql_system)
+ANSWER_SYSTEM = """You are a helpful data assistant.
+Based on the user's question, the SQL query used, and the raw result, write a natural language answer.
+Do not repeat the SQL query. Just give the answer in a clear sentence."""
+
+# Body of a ```sql ... ``` block; a missing closing fence runs to the end of the text
+_FENCE_RE = re.compile(r"```(?:sql)?\s*(.*?)(?:```|$)", re.S | re.I)
+_WS_RE = re.compile(r"\s+")
+
+
+def clean_sql(sql_text: str) -> str:
+    sql_query = (sql_text or "").strip()
+    m = _FENCE_RE.search(sql_query)
+    if m:
+        sql_query = m.group(1)
+    return sql_query.strip().rstrip(";")
+
+
+def format_timings(timings: dict[str, int]) -> str:
+    """
+    One summary line from stage -> nanoseconds, e.g. [sql=812.31ms db=0.42ms total=813.01ms].
+    """
+    return "   [" + " ".join(f"{stage}={ns / 1e6:.2f}ms" for stage, ns in timings.items()) + "]"
+
+
+# The static instructions (and the schema) go into Ollama's system prompt, so every request
+# starts with the same prefix and the server can reuse its KV cache; only the question is new.
+def build_sql_system(schema: str, dialect: str, context: str = "", schema_label: str = "Schema") -> str:
+    """
+    System prompt for the SQL step in the given SQL dialect ("SQLite", "DuckDB SQL").
+    context is appended after the schema (database notes, rules); schema_label heads the schema.
+    """
+    system = f"""You are an expert SQL data analyst.
+Given the following database schema, write a {dialect} query to answer the user's question.
+Return ONLY the SQL query. Do not include markdown formatting like ```sql.
+
+{schema_label}:
+{schema}"""
+    return f"{system}\n\n{context}" if context else system
+
+
+def build_sql_prompt(question: str) -> str:
+    return f"""Question: {question}
+SQL Query:"""
+
+
+def build_answer_prompt(question: str, sql_query: str, raw_result: str) -> str:
+    return f"""Question: {question}
+SQL Query: {sql_query}
+Raw Result: {raw_result}
+
+Answer (in a natural, conversational sentence):"""
+
+
+def build_followup_answer_prompt(raw_result: str) -> str:
+    """
+    Answer prompt sent with the SQL step's context: the question and SQL are already in it.
+    """
+    return f"""Raw Result: {raw_result}
+
+Answer (in a natural, conversational sentence):"""
+
+
+def answer_options(row_count: int) -> dict:
+    if row_count < SMALL_RESULT_ROWS:
+        return {"temperature": 0, "num_predict": 64}
+    return {"temperature": 0}
+
+
+def scalar_answer(question: str, value) -> str:
+    """
+    Phrase a single-value result (COUNT, MAX, AVG, ...) without a round trip to the LLM.
+    """
+    if isinstance(value, float):
+        # Six significant digits: a rate of 0.0034 must not come out as 0.00
+        text = f"{value:.6g}"
+        value = f"{value:.0f}" if "e+" in text else text
+    q = question.strip().lower()
+    if q.startswith("how many"):
+        return f"The count is {value}."
+    if "average" in q or "mean" in q:
+        return f"The average is {value}."
+    if q.startswith(("who", "which")):
+        return f"It is {value}."
+    return f"The answer to your question is {value}."
+
+
+_sql_cache = None
+
+
+def _sql_cache_con() -> sqlite3.Connection:
+    global _sql_cache
+    if _sql_cache is None:
+        _sql_cache = sqlite3.connect(SQL_CACHE_FILE)
+        _sql_cache.execute("CREATE TABLE IF NOT EXISTS sql_cache (key TEXT PRIMARY KEY, sql TEXT NOT NULL)")
+    return _sql_cache
+
+
+@lru_cache(maxsize=8)
+def schema_hash(schema: str) -> str:
+    # The schema only changes on 'refresh', so this is hashed once per session
+    return hashlib.blake2b(schema.encode(), digest_size=16).hexdigest()
+
+
+def sql_cache_key(model: str, question: str, schema: str) -> str:
+    q_norm = _WS_RE.sub(" ", question.strip().lower())
+    return hashlib.blake2b(f"{model}|{q_norm}|{schema_hash(schema)}".encode()).hexdigest()
+
+
+def get_cached_sql(key: str) -> str | None:
+    # The cache only saves a model call: an unreadable cache file counts as a miss, not a failed question
+    try:
+        row = _sql_cache_con().execute("SELECT sql FROM sql_cache WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def put_cached_sql(key: str, sql_query: str) -> None:
+    """
+    Remember SQL that executed successfully, so a failed generation is retried next time.
+    """
+    try:
+        with _sql_cache_con() as cache:
+            cache.execute("INSERT OR REPLACE INTO sql_cache VALUES (?, ?)", (key, sql_query))
+    except sqlite3.Error:
+        pass  # Not cached; the next run asks the model again
+
+
+async def warm_up(client: AsyncClient, *models: str) -> None:
+    """
+    Load the models now so the first question doesn't pay for it.
+    """
+    await asyncio.gather(*[
+        client.generate(model=model, prompt="ok", options={"num_predict": 1}, keep_alive=KEEP_ALIVE)
+        for model in dict.fromkeys(models)
+    ])
+
+
+async def generate(
+    client: AsyncClient, model: str, prompt: str, system: str = ANSWER_SYSTEM, options: dict | None = None,
+    context: list[int] | None = None,
+) -> str:
+    response = await client.generate(
+        model=model, system=system, prompt=prompt, context=context, options=options or {"temperature": 0}, keep_alive=KEEP_ALIVE
+    )
+    return response["response"]
+
+
+def complete_statement(text: str) -> str | None:
+    """
+    The finished statement once the streamed text holds one, else None: everything up to a closing
+    code fence, or up to a blank line after the SQL. A "Here is the query:" preamble is skipped, and
+    whatever arrived after the statement in the same chunk (the start of an explanation) is dropped.
+    """
+    body = text.lstrip()
+    if body.startswith("```"):
+        end = body.find("```", 3)
+        return body[:end + 3] if end != -1 else None
+    head, sep, rest = body.partition("\n\n")
+    if not sep:
+        return None
+    return complete_statement(rest) if head.rstrip().endswith(":") else head
+
+
+async def generate_sql(
+    client: AsyncClient, model: str, system: str, prompt: str, cache_key: str | None = None, structured: bool = False
+):
+    """
+    Stream the SQL for prompt; with a cache_key, previously stored SQL is returned without asking the model.
+    structured=True constrains the output to SQL_FORMAT (for chat models; SQL-only models are prompted
+    to continue a bare "SELECT" and are left unconstrained).
+    Returns (text, context, cached). context holds the conversation tokens when the model finished on its
+    own; passing it to the answer request (same model) lets Ollama skip prefilling the schema again.
+    cached is True when text came from the SQL cache, so there is nothing new to store.
+    """
+    if cache_key is not None:
+        cached = get_cached_sql(cache_key)
+        if cached is not None:
+            return cached, None, True
+    if structured:
+        response = await client.generate(
+            model=model, system=system, prompt=prompt, format=SQL_FORMAT, options=SQL_FORMAT_OPTIONS, keep_alive=KEEP_ALIVE
+        )
+        text = response["response"]
+        try:
+            text = json.loads(text)["sql"]
+        except (ValueError, KeyError, TypeError):
+            pass  # Truncated at num_predict; clean_sql() gets the raw text
+        return text, response.get("context"), False
+    text = ""
+    context = None
+    stream = await client.generate(model=model, system=system, prompt=prompt, stream=True, options=SQL_OPTIONS, keep_alive=KEEP_ALIVE)
+    try:
+        async for chunk in stream:
+            text += chunk["response"]
+            if chunk.get("done"):
+                context = chunk.get("context")
+            elif (statement := complete_statement(text)) is not None:
+                text = statement
+                break
+    finally:
+        # Closing the stream early drops the connection, which also stops decoding on the server
+        await stream.aclose()
+    return text, context, False
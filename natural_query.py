@@ -1,16 +1,21 @@
+import asyncio
 import os
 import sys
 import time
-from langchain_community.utilities import SQLDatabase
-#from langchain_community.llms import Ollama
-from langchain_ollama import OllamaLLM
+from ollama import AsyncClient
+from llm_common import (
+    OLLAMA_HOST, VERBOSE, answer_options, build_answer_prompt, build_followup_answer_prompt, build_sql_prompt,
+    build_sql_system, clean_sql, format_timings, generate, generate_sql, put_cached_sql, scalar_answer, sql_cache_key,
+    warm_up,
+)
+from nl_sqlite_common import load_schema, run_sql, sqlite_engine
 
 # Configuration
 DB_FILE = 'sumobot.db'
 MODEL_NAME = "gemma3:4b" #"qwen2.5-coder:7b" #"deepseek-coder:6.7b" #"duckdb-nsql:7b" #"sqlcoder:7b" #"llama3" 
 # Removed: #"qwen2.5-coder:3b"  
 
-def get_engine():
+async def get_engine():
     """
     Initializes the Database and LLM.
     """
@@ -18,93 +23,148 @@ def get_engine():
         raise FileNotFoundError(f"Database {DB_FILE} not found. Please run 'python setup_database.py' first.")
 
     # Connect to the SQLite database
-    db = SQLDatabase.from_uri(f"sqlite:///{DB_FILE}")
+    engine = sqlite_engine(DB_FILE)
     
     print(f"Connecting to local LLM via Ollama (model: {MODEL_NAME})...")
     try:
-        # Use 127.0.0.1 to avoid localhost resolution issues on Windows
-        llm = OllamaLLM(model=MODEL_NAME, temperature=0, base_url="http://127.0.0.1:11434")
+        client = AsyncClient(host=OLLAMA_HOST)
+        await warm_up(client, MODEL_NAME)
     except Exception as e:
         print(f"Error connecting to Ollama: {e}")
         raise
         
-    return db, llm
+    # The schema is static for the session, so build the prompt string once here
+    schema = load_schema(engine)
 
-def run_query_pipeline(db, llm, question):
+    return engine, client, schema
+
+async def run_query_pipeline(engine, client, schema, question):
     """
     Manually runs the Text -> SQL -> Result -> Text pipeline for better control.
     """
-    # 1. Get Schema
-    schema = db.get_table_info()
-    
-    t_start_total = time.time()
+    t_start_total = time.perf_counter_ns()
+    timings = {}
 
     # 2. Generate SQL
-    sql_prompt = f"""You are an expert SQL data analyst. 
-    Given the following database schema, write a SQLite query to answer the user's question.
-    Return ONLY the SQL query. Do not include markdown formatting like ```sql.
-    
-    Schema:
-    {schema}
+    sql_prompt = build_sql_prompt(question)
     
-    Question: {question}
-    SQL Query:"""
-    
-    print("Thinking (Generating SQL)...")
-    t1_start = time.time()
-    sql_response = llm.invoke(sql_prompt)
-    t1_end = time.time()
+    if VERBOSE:
+        print("Thinking (Generating SQL)...")
+    t1_start = time.perf_counter_ns()
+    cache_key = sql_cache_key(MODEL_NAME, question, schema)
+    sql_response, context, cached = await generate_sql(client, MODEL_NAME, build_sql_system(schema, "SQLite"), sql_prompt, cache_key, structured=True)
+    t1_end = time.perf_counter_ns()
     
     # Clean SQL
-    sql_query = sql_response.strip()
-    # Remove markdown code blocks if present
-    if "```" in sql_query:
-        # Find the content inside the backticks
-        parts = sql_query.split("```")
-        if len(parts) >= 2:
-            sql_query = parts[1]
-            if sql_query.lower().startswith("sql"):
-                sql_query = sql_query[3:]
-    
-    sql_query = sql_query.strip()
+    sql_query = clean_sql(sql_response)
         
     print(f">> Generated SQL: {sql_query}")
-    print(f"   (SQL Gen Time: {(t1_end - t1_start)*1000:.4f} ms)")
+    timings["sql"] = t1_end - t1_start
     
     # 3. Execute SQL
     try:
-        print("Executing...")
-        t2_start = time.time()
-        result = db.run(sql_query)
-        t2_end = time.time()
-        print(f"   (DB Exec Time: {(t2_end - t2_start)*1000:.2f} ms)")
+        if VERBOSE:
+            print("Executing...")
+        t2_start = time.perf_counter_ns()
+        result, scalar, row_count = run_sql(engine, sql_query)
+        t2_end = time.perf_counter_ns()
+        timings["db"] = t2_end - t2_start
         # print(f">> Raw Result: {result}") # Optional: print raw result for debugging
     except Exception as e:
         return f"Error executing SQL: {e}"
+    if not cached:
+        put_cached_sql(cache_key, sql_query)
         
-    # 4. Generate Natural Answer
-    answer_prompt = f"""You are a helpful data assistant.
-        Based on the user's question, the SQL query used, and the raw result, write a natural language answer.
-        Do not repeat the SQL query. Just give the answer in a clear sentence.
-        
-        Question: {question}
-        SQL Query: {sql_query}
-        Raw Result: {result}
-        
-        Answer (in a natural, conversational sentence):"""
+    # 4. Generate Natural Answer (a single value is phrased directly)
+    if scalar is not None:
+        timings["total"] = t2_end - t_start_total
+        print(format_timings(timings))
+        return scalar_answer(question, scalar)
+
+    # With the SQL step's context, the question and SQL are already known to the model
+    if context:
+        answer_prompt = build_followup_answer_prompt(result)
+    else:
+        answer_prompt = build_answer_prompt(question, sql_query, result)
     
-    print("Formulating answer...")
-    t3_start = time.time()
-    final_answer = llm.invoke(answer_prompt)
-    t3_end = time.time()
-    print(f"   (Answer Gen Time: {(t3_end - t3_start)*1000:.2f} ms)")
+    if VERBOSE:
+        print("Formulating answer...")
+    t3_start = time.perf_counter_ns()
+    final_answer = await generate(client, MODEL_NAME, answer_prompt, options=answer_options(row_count), context=context)
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t3_start
     
-    t_end_total = time.time()
-    print(f"   [Total Time: {(t_end_total - t_start_total)*1000:.2f} ms]")
+    t_end_total = time.perf_counter_ns()
+    timings["total"] = t_end_total - t_start_total
+    print(format_timings(timings))
 
     return final_answer
 
-def main():
+async def run_batch(engine, client, schema, questions):
+    """
+    Runs the pipeline for several questions at once.
+    Both LLM stages are sent concurrently across the batch; SQL runs sequentially.
+    """
+    t_start_total = time.perf_counter_ns()
+    timings = {}
+
+    if VERBOSE:
+        print(f"Thinking (Generating SQL for {len(questions)} questions)...")
+    cache_keys = [sql_cache_key(MODEL_NAME, q, schema) for q in questions]
+    sql_system = build_sql_system(schema, "SQLite")
+    sql_responses = await asyncio.gather(
+        *[generate_sql(client, MODEL_NAME, sql_system, build_sql_prompt(q), key, structured=True)
+          for q, key in zip(questions, cache_keys)],
+        return_exceptions=True,
+    )
+    t1_end = time.perf_counter_ns()
+    timings["sql"] = t1_end - t_start_total
+
+    answers = [None] * len(questions)
+    pending = []  # (index, answer_prompt, options, context)
+    new_sql = []  # (cache_key, sql_query), stored once the stages are timed
+    for i, (question, sql_response) in enumerate(zip(questions, sql_responses)):
+        if isinstance(sql_response, Exception):
+            answers[i] = f"Error communicating with Ollama: {sql_response}"
+            continue
+        sql_response, context, cached = sql_response
+        sql_query = clean_sql(sql_response)
+        try:
+            result, scalar, row_count = run_sql(engine, sql_query)
+        except Exception as e:
+            answers[i] = f"Error executing SQL: {e}"
+            continue
+        if not cached:
+            new_sql.append((cache_keys[i], sql_query))
+        if scalar is not None:
+            answers[i] = scalar_answer(question, scalar)
+            continue
+        if context:
+            answer_prompt = build_followup_answer_prompt(result)
+        else:
+            answer_prompt = build_answer_prompt(question, sql_query, result)
+        pending.append((i, answer_prompt, answer_options(row_count), context))
+    t2_end = time.perf_counter_ns()
+    timings["db"] = t2_end - t1_end
+
+    if VERBOSE:
+        print("Formulating answers...")
+    final_answers = await asyncio.gather(
+        *[generate(client, MODEL_NAME, prompt, options=options, context=context) for _, prompt, options, context in pending],
+        return_exceptions=True,
+    )
+    for (i, *_), final_answer in zip(pending, final_answers):
+        answers[i] = f"Error communicating with Ollama: {final_answer}" if isinstance(final_answer, Exception) else final_answer
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t2_end
+    timings["total"] = t3_end - t_start_total
+    print(format_timings(timings))
+
+    for cache_key, sql_query in new_sql:
+        put_cached_sql(cache_key, sql_query)
+    return answers
+
+async def main():
     print("==========================================")
     print("   Sumobot Natural Query Interface")
     print("==========================================")
@@ -113,12 +173,20 @@ def main():
     print("------------------------------------------")
     
     try:
-        db, llm = get_engine()
+        engine, client, schema = await get_engine()
     except Exception as e:
         print(f"Initialization failed: {e}")
         return
 
-    print("\nSystem ready. Type 'exit' to quit.")
+    # Questions passed on the command line are answered as one concurrent batch
+    if len(sys.argv) > 1:
+        questions = sys.argv[1:]
+        answers = await run_batch(engine, client, schema, questions)
+        for question, answer in zip(questions, answers):
+            print(f"\n>> Question: {question}\n>> Answer: {answer}")
+        return
+
+    print("\nSystem ready. Type 'exit' to quit, 'refresh' to reload the schema.")
     print("Example: 'Who won the most games?'")
     
     while True:
@@ -128,8 +196,12 @@ def main():
                 continue
             if question.lower() in ['exit', 'quit', 'q']:
                 break
+            if question.lower() == 'refresh':
+                schema = load_schema(engine)
+                print("Schema reloaded.")
+                continue
             
-            response = run_query_pipeline(db, llm, question)
+            response = await run_query_pipeline(engine, client, schema, question)
             
             print(f"\n>> Answer: {response}")
             
@@ -140,4 +212,4 @@ def main():
             print(f"\nError processing query: {e}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
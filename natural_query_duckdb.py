@@ -1,54 +1,21 @@
+import asyncio
 import os
+import sys
 import time
 import duckdb
-#from langchain_community.llms import Ollama
-from langchain_ollama import OllamaLLM
+from ollama import AsyncClient
+from llm_common import (
+    OLLAMA_HOST, VERBOSE, answer_options, build_answer_prompt, build_followup_answer_prompt, build_sql_prompt,
+    build_sql_system, clean_sql, format_timings, generate, generate_sql, put_cached_sql, scalar_answer, sql_cache_key, warm_up,
+)
+from nl_sql_common import DUCKDB_CONFIG, SCHEMA_LABEL, format_schema, is_safe_readonly, run_sql
 
 # Configuration
 DB_FILE = "sumobot.duckdb"   # DuckDB database file produced by setup_database_duckdb.py
 MODEL_NAME = "llama3"     # via Ollama
 
 
-def _format_schema(con: duckdb.DuckDBPyConnection) -> str:
-    """
-    Build a compact schema string for the LLM prompt (DuckDB).
-    """
-    try:
-        tables = [r[0] for r in con.execute("SHOW TABLES").fetchall()]
-    except Exception:
-        # Fallback via information_schema (rarely needed)
-        tables = [r[0] for r in con.execute(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='main'"
-        ).fetchall()]
-
-    if not tables:
-        return "(No tables found.)"
-
-    parts = []
-    for t in tables:
-        try:
-            # PRAGMA table_info returns: cid, name, type, notnull, dflt_value, pk
-            cols = con.execute(f"PRAGMA table_info('{t}')").fetchall()
-        except Exception as e:
-            parts.append(f"Table {t}: <error reading columns: {e}>")
-            continue
-
-        col_lines = []
-        for _, name, coltype, notnull, dflt, pk in cols:
-            extras = []
-            if pk:
-                extras.append("PK")
-            if notnull:
-                extras.append("NOT NULL")
-            if dflt is not None:
-                extras.append(f"DEFAULT {dflt}")
-            extra_str = (" " + " ".join(extras)) if extras else ""
-            col_lines.append(f"  {name} {coltype}{extra_str}")
-        parts.append(f"Table {t}(\n" + ",\n".join(col_lines) + "\n)")
-    return "\n\n".join(parts)
-
-
-def get_engine():
+async def get_engine():
     """
     Initializes the DuckDB connection and the local LLM (Ollama).
     """
@@ -57,129 +24,178 @@ def get_engine():
             f"Database {DB_FILE} not found. Please run 'python setup_database_duckdb.py' first."
         )
 
-    con = duckdb.connect(DB_FILE, read_only=False)
+    # Generated SQL is restricted to reads (is_safe_readonly), so skip the write/WAL machinery
+    con = duckdb.connect(DB_FILE, read_only=True, config=DUCKDB_CONFIG)
 
     print(f"Connecting to local LLM via Ollama (model: {MODEL_NAME})...")
-    # Use 127.0.0.1 to avoid localhost resolution issues on Windows
-    llm = OllamaLLM(model=MODEL_NAME, temperature=0, base_url="http://127.0.0.1:11434")
+    client = AsyncClient(host=OLLAMA_HOST)
+    try:
+        await warm_up(client, MODEL_NAME)
+    except Exception as e:
+        print(f"Error connecting to Ollama: {e}")
+        raise
+
+    # The schema is static for the session, so build the prompt string once here
+    schema = format_schema(con)
 
-    return con, llm
+    return con, client, schema
 
 
-def _clean_sql(sql_text: str) -> str:
-    sql_query = (sql_text or "").strip()
-    if "```" in sql_query:
-        parts = sql_query.split("```")
-        if len(parts) >= 2:
-            sql_query = parts[1].strip()
-            if sql_query.lower().startswith("sql"):
-                sql_query = sql_query[3:].strip()
-    return sql_query.strip().rstrip(";")
+def _build_sql_system(schema: str) -> str:
+    return build_sql_system(schema, "DuckDB SQL", schema_label=SCHEMA_LABEL)
 
 
-def _is_safe_readonly(sql_query: str) -> bool:
+def _execute_sql(con: duckdb.DuckDBPyConnection, sql_query: str):
     """
-    Optional guardrail: allow only read-only queries by default.
-    You can loosen this if you want to support CREATE VIEW, etc.
+    Validate and run the generated SQL.
+    Returns (error, raw_result, scalar, row_count); on failure only error is set, see run_sql for the rest.
     """
-    q = (sql_query or "").strip().lower()
-    # Allow WITH ... SELECT ...
-    if q.startswith("with "):
-        return True
-    return q.startswith("select ") or q.startswith("show ") or q.startswith("describe ") or q.startswith("pragma ")
+    if not sql_query:
+        return "Error: LLM returned an empty SQL query.", None, None, None
 
+    # Optional safety: block non-read-only queries
+    if not is_safe_readonly(sql_query):
+        return (
+            "Blocked a non-read-only query for safety.\n"
+            f"Generated query was: {sql_query}\n"
+            "If you want to allow writes/DDL, edit is_safe_readonly() in nl_sql_common.py."
+        ), None, None, None
 
-def run_query_pipeline(con: duckdb.DuckDBPyConnection, llm, question: str) -> str:
+    try:
+        return None, *run_sql(con, sql_query)
+    except Exception as e:
+        return f"Error executing DuckDB SQL: {e}", None, None, None
+
+
+async def run_query_pipeline(con: duckdb.DuckDBPyConnection, client: AsyncClient, schema: str, question: str) -> str:
     """
     Text -> DuckDB SQL -> Result -> Text
     """
-    schema = _format_schema(con)
-
-    t_start_total = time.time()
+    t_start_total = time.perf_counter_ns()
+    timings = {}
 
     # 1) Generate DuckDB SQL
-    sql_prompt = f"""You are an expert SQL data analyst.
-Given the following database schema, write a DuckDB SQL query to answer the user's question.
-Return ONLY the SQL query. Do not include markdown formatting like ```sql.
+    sql_prompt = build_sql_prompt(question)
 
-Schema:
-{schema}
-
-Question: {question}
-SQL Query:"""
-
-    print("Thinking (Generating SQL)...")
-    t1_start = time.time()
+    if VERBOSE:
+        print("Thinking (Generating SQL)...")
+    t1_start = time.perf_counter_ns()
     try:
-        sql_response = llm.invoke(sql_prompt)
+        cache_key = sql_cache_key(MODEL_NAME, question, schema)
+        sql_response, context, cached = await generate_sql(client, MODEL_NAME, _build_sql_system(schema), sql_prompt, cache_key, structured=True)
     except Exception as e:
         return f"Error communicating with Ollama: {e}\nEnsure Ollama is running (try 'ollama serve' or check tray icon)."
-    t1_end = time.time()
+    t1_end = time.perf_counter_ns()
 
-    sql_query = _clean_sql(sql_response)
+    sql_query = clean_sql(sql_response)
 
     print(f">> Generated SQL: {sql_query}")
-    print(f"   (SQL Gen Time: {(t1_end - t1_start) * 1000:.2f} ms)")
-
-    if not sql_query:
-        return "Error: LLM returned an empty SQL query."
-
-    # Optional safety: block non-read-only queries
-    if not _is_safe_readonly(sql_query):
-        return (
-            "Blocked a non-read-only query for safety.\n"
-            f"Generated query was: {sql_query}\n"
-            "If you want to allow writes/DDL, edit _is_safe_readonly()."
-        )
+    timings["sql"] = t1_end - t1_start
 
     # 2) Execute against DuckDB
-    try:
+    if VERBOSE:
         print("Executing...")
-        t2_start = time.time()
-
-        # Prefer a dataframe result for nicer display (requires pandas)
-        result_obj = None
-        try:
-            result_obj = con.execute(sql_query).fetchdf()
-        except Exception:
-            result_obj = con.execute(sql_query).fetchall()
-
-        t2_end = time.time()
-        print(f"   (DB Exec Time: {(t2_end - t2_start) * 1000:.2f} ms)")
-    except Exception as e:
-        return f"Error executing DuckDB SQL: {e}"
-
-    # Prepare raw result string for LLM answer
-    if hasattr(result_obj, "to_string"):
-        # pandas DataFrame
-        raw_result = result_obj.head(50).to_string(index=False)
+    t2_start = time.perf_counter_ns()
+    error, raw_result, scalar, row_count = _execute_sql(con, sql_query)
+    t2_end = time.perf_counter_ns()
+    if error:
+        return error
+    timings["db"] = t2_end - t2_start
+    # Stored outside the db timing: the cache commit costs more than most DuckDB queries
+    if not cached:
+        put_cached_sql(cache_key, sql_query)
+
+    # 3) Natural language answer (a single value is phrased directly)
+    if scalar is not None:
+        timings["total"] = t2_end - t_start_total
+        print(format_timings(timings))
+        return scalar_answer(question, scalar)
+
+    # With the SQL step's context, the question and SQL are already known to the model
+    if context:
+        answer_prompt = build_followup_answer_prompt(raw_result)
     else:
-        raw_result = str(result_obj[:50]) if isinstance(result_obj, list) else str(result_obj)
+        answer_prompt = build_answer_prompt(question, sql_query, raw_result)
 
-    # 3) Natural language answer
-    answer_prompt = f"""You are a helpful data assistant.
-        Based on the user's question, the SQL query used, and the raw result, write a natural language answer.
-        Do not repeat the SQL query. Just give the answer in a clear sentence.
+    if VERBOSE:
+        print("Formulating answer...")
+    t3_start = time.perf_counter_ns()
+    final_answer = await generate(client, MODEL_NAME, answer_prompt, options=answer_options(row_count), context=context)
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t3_start
 
-        Question: {question}
-        SQL Query: {sql_query}
-        Raw Result: {raw_result}
-
-        Answer (in a natural, conversational sentence):"""
-
-    print("Formulating answer...")
-    t3_start = time.time()
-    final_answer = llm.invoke(answer_prompt)
-    t3_end = time.time()
-    print(f"   (Answer Gen Time: {(t3_end - t3_start) * 1000:.2f} ms)")
-
-    t_end_total = time.time()
-    print(f"   [Total Time: {(t_end_total - t_start_total) * 1000:.2f} ms]")
+    t_end_total = time.perf_counter_ns()
+    timings["total"] = t_end_total - t_start_total
+    print(format_timings(timings))
 
     return final_answer
 
 
-def main():
+async def run_batch(con: duckdb.DuckDBPyConnection, client: AsyncClient, schema: str, questions: list[str]) -> list[str]:
+    """
+    Runs the pipeline for several questions at once.
+    Both LLM stages are sent concurrently across the batch; SQL runs sequentially on the shared connection.
+    """
+    t_start_total = time.perf_counter_ns()
+    timings = {}
+
+    if VERBOSE:
+        print(f"Thinking (Generating SQL for {len(questions)} questions)...")
+    cache_keys = [sql_cache_key(MODEL_NAME, q, schema) for q in questions]
+    sql_system = _build_sql_system(schema)
+    sql_responses = await asyncio.gather(
+        *[generate_sql(client, MODEL_NAME, sql_system, build_sql_prompt(q), key, structured=True)
+          for q, key in zip(questions, cache_keys)],
+        return_exceptions=True,
+    )
+    t1_end = time.perf_counter_ns()
+    timings["sql"] = t1_end - t_start_total
+
+    answers = [None] * len(questions)
+    pending = []  # (index, answer_prompt, options, context)
+    new_sql = []  # (cache_key, sql_query), stored once the stages are timed
+    for i, (question, sql_response) in enumerate(zip(questions, sql_responses)):
+        if isinstance(sql_response, Exception):
+            answers[i] = f"Error communicating with Ollama: {sql_response}"
+            continue
+        sql_response, context, cached = sql_response
+        sql_query = clean_sql(sql_response)
+        error, raw_result, scalar, row_count = _execute_sql(con, sql_query)
+        if error:
+            answers[i] = error
+            continue
+        if not cached:
+            new_sql.append((cache_keys[i], sql_query))
+        if scalar is not None:
+            answers[i] = scalar_answer(question, scalar)
+            continue
+        if context:
+            answer_prompt = build_followup_answer_prompt(raw_result)
+        else:
+            answer_prompt = build_answer_prompt(question, sql_query, raw_result)
+        pending.append((i, answer_prompt, answer_options(row_count), context))
+    t2_end = time.perf_counter_ns()
+    timings["db"] = t2_end - t1_end
+
+    if VERBOSE:
+        print("Formulating answers...")
+    final_answers = await asyncio.gather(
+        *[generate(client, MODEL_NAME, prompt, options=options, context=context) for _, prompt, options, context in pending],
+        return_exceptions=True,
+    )
+    for (i, *_), final_answer in zip(pending, final_answers):
+        answers[i] = f"Error communicating with Ollama: {final_answer}" if isinstance(final_answer, Exception) else final_answer
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t2_end
+    timings["total"] = t3_end - t_start_total
+    print(format_timings(timings))
+
+    for cache_key, sql_query in new_sql:
+        put_cached_sql(cache_key, sql_query)
+    return answers
+
+
+async def main():
     print("==========================================")
     print("   Sumobot Natural Query Interface (DuckDB)")
     print("==========================================")
@@ -188,12 +204,21 @@ def main():
     print("------------------------------------------")
 
     try:
-        con, llm = get_engine()
+        con, client, schema = await get_engine()
     except Exception as e:
         print(f"Initialization failed: {e}")
         return
 
-    print("\nSystem ready. Type 'exit' to quit.")
+    # Questions passed on the command line are answered as one concurrent batch
+    if len(sys.argv) > 1:
+        questions = sys.argv[1:]
+        answers = await run_batch(con, client, schema, questions)
+        for question, answer in zip(questions, answers):
+            print(f"\n>> Question: {question}\n>> Answer: {answer}")
+        con.close()
+        return
+
+    print("\nSystem ready. Type 'exit' to quit, 'refresh' to reload the schema and clear cached results.")
     print("Example: 'Who won the most games?'")
 
     while True:
@@ -203,8 +228,13 @@ def main():
                 continue
             if question.lower() in ["exit", "quit", "q"]:
                 break
+            if question.lower() == "refresh":
+                schema = format_schema(con)
+                run_sql.cache_clear()
+                print("Schema reloaded.")
+                continue
 
-            response = run_query_pipeline(con, llm, question)
+            response = await run_query_pipeline(con, client, schema, question)
             print(f"\n>> Answer: {response}")
 
         except KeyboardInterrupt:
@@ -220,4 +250,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,15 +1,31 @@
+import asyncio
 import os
 import sys
 import time
 import sqlite3
-from langchain_community.utilities import SQLDatabase
-from langchain_ollama import OllamaLLM
+from ollama import AsyncClient
+from llm_common import (
+    OLLAMA_HOST, VERBOSE, answer_options, build_answer_prompt, build_followup_answer_prompt, build_sql_prompt,
+    build_sql_system, clean_sql, format_timings, generate, generate_sql, put_cached_sql, scalar_answer, sql_cache_key,
+    warm_up,
+)
+from nl_sqlite_common import load_schema, run_sql, sqlite_engine
 
 # Configuration
 DB_FILE = 'sample_game.sqlite'
 MODEL_NAME = "sqlcoder:7b"
+# SQL-specialized models (sqlcoder, duckdb-nsql) expect their own prompt format
+SQL_ONLY_MODEL = "sqlcoder" in MODEL_NAME.lower() or "nsql" in MODEL_NAME.lower()
+# Chat models answer in JSON-constrained form; SQL-only models complete the "SELECT" prompt as text
+STRUCTURED_SQL = not SQL_ONLY_MODEL
 
-def get_engine():
+DATABASE_CONTEXT = """Database Context:
+- bots: Contains bot information (bot_id, name, language, author, created_at)
+- matches: Contains match records between two bots (left_bot_id, right_bot_id, winner_bot_id, duration_s)
+- rounds: Contains round-level data for each match (each match can have multiple rounds)
+- events: Contains detailed game events (actions, positions, states) for each round"""
+
+async def get_engine():
     """
     Initializes the Database and LLM.
     """
@@ -17,81 +33,70 @@ def get_engine():
         raise FileNotFoundError(f"Database {DB_FILE} not found. Please ensure the file exists in the current directory.")
 
     # Connect to the SQLite database
-    db = SQLDatabase.from_uri(f"sqlite:///{DB_FILE}")
+    engine = sqlite_engine(DB_FILE)
     
     print(f"Connecting to local LLM via Ollama (model: {MODEL_NAME})...")
     try:
-        # Use 127.0.0.1 to avoid localhost resolution issues on Windows
-        llm = OllamaLLM(model=MODEL_NAME, temperature=0, base_url="http://127.0.0.1:11434")
+        client = AsyncClient(host=OLLAMA_HOST)
+        await warm_up(client, MODEL_NAME)
     except Exception as e:
         print(f"Error connecting to Ollama: {e}")
         raise
         
-    return db, llm
+    # The schema is static for the session, so build the prompt string once here
+    schema = load_schema(engine)
 
-def run_query_pipeline(db, llm, question):
-    """
-    Manually runs the Text -> SQL -> Result -> Text pipeline for better control.
-    """
-    # 1. Get Schema
-    schema = db.get_table_info()
-    
-    t_start_total = time.time()
+    return engine, client, schema
 
-    # 2. Generate SQL with enhanced context about the schema
+def _build_sql_system(schema):
     # Use simpler format for SQL-specialized models like sqlcoder
-    if "sqlcoder" in MODEL_NAME.lower() or "nsql" in MODEL_NAME.lower():
-        sql_prompt = f"""### Task
-Generate a SQL query to answer the following question: {question}
+    if SQL_ONLY_MODEL:
+        return f"""### Database Schema
+{schema}"""
+    return build_sql_system(schema, "SQLite", DATABASE_CONTEXT)
 
-### Database Schema
-{schema}
+def _build_sql_prompt(question):
+    if SQL_ONLY_MODEL:
+        return f"""### Task
+Generate a SQL query to answer the following question: {question}
 
 ### SQL Query
 SELECT"""
-    else:
-        sql_prompt = f"""You are an expert SQL data analyst. 
-Given the following database schema, write a SQLite query to answer the user's question.
-Return ONLY the SQL query. Do not include markdown formatting like ```sql.
+    return build_sql_prompt(question)
 
-Schema:
-{schema}
+def _clean_sql(sql_response):
+    # Remove markdown code blocks if present (before the SELECT fix-up, so a fence is never prefixed)
+    sql_query = clean_sql(sql_response)
+    
+    # For SQL-specialized models, prepend SELECT if it's missing
+    if SQL_ONLY_MODEL:
+        if sql_query and not sql_query.upper().startswith("SELECT"):
+            sql_query = "SELECT " + sql_query
+    
+    return sql_query.strip()
 
-Database Context:
-- bots: Contains bot information (bot_id, name, language, author, created_at)
-- matches: Contains match records between two bots (left_bot_id, right_bot_id, winner_bot_id, duration_s)
-- rounds: Contains round-level data for each match (each match can have multiple rounds)
-- events: Contains detailed game events (actions, positions, states) for each round
+async def run_query_pipeline(engine, client, schema, question):
+    """
+    Manually runs the Text -> SQL -> Result -> Text pipeline for better control.
+    """
+    t_start_total = time.perf_counter_ns()
+    timings = {}
 
-Question: {question}
-SQL Query:"""
+    # 2. Generate SQL with enhanced context about the schema
+    sql_prompt = _build_sql_prompt(question)
     
-    print("Thinking (Generating SQL)...")
-    t1_start = time.time()
+    if VERBOSE:
+        print("Thinking (Generating SQL)...")
+    t1_start = time.perf_counter_ns()
     try:
-        sql_response = llm.invoke(sql_prompt)
+        cache_key = sql_cache_key(MODEL_NAME, question, schema)
+        sql_response, context, cached = await generate_sql(client, MODEL_NAME, _build_sql_system(schema), sql_prompt, cache_key, structured=STRUCTURED_SQL)
     except Exception as e:
         return f"Error communicating with LLM: {e}\nEnsure Ollama is running and the model '{MODEL_NAME}' is available."
-    t1_end = time.time()
+    t1_end = time.perf_counter_ns()
     
     # Clean SQL
-    sql_query = (sql_response or "").strip()
-    
-    # For SQL-specialized models, prepend SELECT if it's missing
-    if "sqlcoder" in MODEL_NAME.lower() or "nsql" in MODEL_NAME.lower():
-        if sql_query and not sql_query.upper().startswith("SELECT"):
-            sql_query = "SELECT " + sql_query
-    
-    # Remove markdown code blocks if present
-    if "```" in sql_query:
-        # Find the content inside the backticks
-        parts = sql_query.split("```")
-        if len(parts) >= 2:
-            sql_query = parts[1]
-            if sql_query.lower().startswith("sql"):
-                sql_query = sql_query[3:]
-    
-    sql_query = sql_query.strip()
+    sql_query = _clean_sql(sql_response)
     
     # Debug: Show what the LLM actually returned
     if not sql_query:
@@ -100,41 +105,114 @@ SQL Query:"""
         return f"Error: LLM returned an empty SQL query. Raw response: {repr(sql_response)[:200]}"
         
     print(f">> Generated SQL: {sql_query}")
-    print(f"   (SQL Gen Time: {(t1_end - t1_start)*1000:.4f} ms)")
+    timings["sql"] = t1_end - t1_start
     
     # 3. Execute SQL
     try:
-        print("Executing...")
-        t2_start = time.time()
-        result = db.run(sql_query)
-        t2_end = time.time()
-        print(f"   (DB Exec Time: {(t2_end - t2_start)*1000:.4f} ms)")
+        if VERBOSE:
+            print("Executing...")
+        t2_start = time.perf_counter_ns()
+        result, scalar, row_count = run_sql(engine, sql_query)
+        t2_end = time.perf_counter_ns()
+        timings["db"] = t2_end - t2_start
     except Exception as e:
         return f"Error executing SQL: {e}\nGenerated query was: {sql_query}"
+    if not cached:
+        put_cached_sql(cache_key, sql_query)
         
-    # 4. Generate Natural Answer
-    answer_prompt = f"""You are a helpful data assistant.
-        Based on the user's question, the SQL query used, and the raw result, write a natural language answer.
-        Do not repeat the SQL query. Just give the answer in a clear sentence.
-        
-        Question: {question}
-        SQL Query: {sql_query}
-        Raw Result: {result}
-        
-        Answer (in a natural, conversational sentence):"""
+    # 4. Generate Natural Answer (a single value is phrased directly)
+    if scalar is not None:
+        timings["total"] = t2_end - t_start_total
+        print(format_timings(timings))
+        return scalar_answer(question, scalar)
+
+    # With the SQL step's context, the question and SQL are already known to the model
+    if context:
+        answer_prompt = build_followup_answer_prompt(result)
+    else:
+        answer_prompt = build_answer_prompt(question, sql_query, result)
     
-    print("Formulating answer...")
-    t3_start = time.time()
-    final_answer = llm.invoke(answer_prompt)
-    t3_end = time.time()
-    print(f"   (Answer Gen Time: {(t3_end - t3_start)*1000:.4f} ms)")
+    if VERBOSE:
+        print("Formulating answer...")
+    t3_start = time.perf_counter_ns()
+    final_answer = await generate(client, MODEL_NAME, answer_prompt, options=answer_options(row_count), context=context)
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t3_start
     
-    t_end_total = time.time()
-    print(f"   [Total Time: {(t_end_total - t_start_total)*1000:.4f} ms]")
+    t_end_total = time.perf_counter_ns()
+    timings["total"] = t_end_total - t_start_total
+    print(format_timings(timings))
 
     return final_answer
 
-def main():
+async def run_batch(engine, client, schema, questions):
+    """
+    Runs the pipeline for several questions at once.
+    Both LLM stages are sent concurrently across the batch; SQL runs sequentially.
+    """
+    t_start_total = time.perf_counter_ns()
+    timings = {}
+
+    if VERBOSE:
+        print(f"Thinking (Generating SQL for {len(questions)} questions)...")
+    cache_keys = [sql_cache_key(MODEL_NAME, q, schema) for q in questions]
+    sql_system = _build_sql_system(schema)
+    sql_responses = await asyncio.gather(
+        *[generate_sql(client, MODEL_NAME, sql_system, _build_sql_prompt(q), key, structured=STRUCTURED_SQL)
+          for q, key in zip(questions, cache_keys)],
+        return_exceptions=True,
+    )
+    t1_end = time.perf_counter_ns()
+    timings["sql"] = t1_end - t_start_total
+
+    answers = [None] * len(questions)
+    pending = []  # (index, answer_prompt, options, context)
+    new_sql = []  # (cache_key, sql_query), stored once the stages are timed
+    for i, (question, sql_response) in enumerate(zip(questions, sql_responses)):
+        if isinstance(sql_response, Exception):
+            answers[i] = f"Error communicating with LLM: {sql_response}"
+            continue
+        sql_response, context, cached = sql_response
+        sql_query = _clean_sql(sql_response)
+        if not sql_query:
+            answers[i] = f"Error: LLM returned an empty SQL query. Raw response: {repr(sql_response)[:200]}"
+            continue
+        try:
+            result, scalar, row_count = run_sql(engine, sql_query)
+        except Exception as e:
+            answers[i] = f"Error executing SQL: {e}\nGenerated query was: {sql_query}"
+            continue
+        if not cached:
+            new_sql.append((cache_keys[i], sql_query))
+        if scalar is not None:
+            answers[i] = scalar_answer(question, scalar)
+            continue
+        if context:
+            answer_prompt = build_followup_answer_prompt(result)
+        else:
+            answer_prompt = build_answer_prompt(question, sql_query, result)
+        pending.append((i, answer_prompt, answer_options(row_count), context))
+    t2_end = time.perf_counter_ns()
+    timings["db"] = t2_end - t1_end
+
+    if VERBOSE:
+        print("Formulating answers...")
+    final_answers = await asyncio.gather(
+        *[generate(client, MODEL_NAME, prompt, options=options, context=context) for _, prompt, options, context in pending],
+        return_exceptions=True,
+    )
+    for (i, *_), final_answer in zip(pending, final_answers):
+        answers[i] = f"Error communicating with LLM: {final_answer}" if isinstance(final_answer, Exception) else final_answer
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t2_end
+    timings["total"] = t3_end - t_start_total
+    print(format_timings(timings))
+
+    for cache_key, sql_query in new_sql:
+        put_cached_sql(cache_key, sql_query)
+    return answers
+
+async def main():
     print("==========================================")
     print("   Sumobot Sample Game Query Interface")
     print("==========================================")
@@ -143,24 +221,29 @@ def main():
     print("------------------------------------------")
     
     try:
-        db, llm = get_engine()
+        engine, client, schema = await get_engine()
     except Exception as e:
         print(f"Initialization failed: {e}")
         return
 
-    # Dynamically report table row counts
-    table_counts = {}
+    # Questions passed on the command line are answered as one concurrent batch
+    if len(sys.argv) > 1:
+        questions = sys.argv[1:]
+        answers = await run_batch(engine, client, schema, questions)
+        for question, answer in zip(questions, answers):
+            print(f"\n>> Question: {question}\n>> Answer: {answer}")
+        return
+
+    # Dynamically report table row counts (one round trip for all tables)
+    tables = ("bots", "matches", "rounds", "events")
     try:
         with sqlite3.connect(DB_FILE) as conn:
-            cur = conn.cursor()
-            for table in ["bots", "matches", "rounds", "events"]:
-                try:
-                    cur.execute(f"SELECT COUNT(*) FROM {table}")
-                    table_counts[table] = cur.fetchone()[0]
-                except Exception:
-                    table_counts[table] = "?"
+            row = conn.execute(
+                "SELECT " + ", ".join(f"(SELECT COUNT(*) FROM {table})" for table in tables)
+            ).fetchone()
+        table_counts = dict(zip(tables, row))
     except Exception:
-        table_counts = {t: "?" for t in ["bots", "matches", "rounds", "events"]}
+        table_counts = {t: "?" for t in tables}
 
     print("\nDatabase contains:")
     print(f"  - {table_counts.get('bots', '?')} bots (with names, languages, authors)")
@@ -169,7 +252,7 @@ def main():
     print(f"  - {table_counts.get('events', '?')} events (detailed game actions/positions)")
     print("------------------------------------------")
 
-    print("\nSystem ready. Type 'exit' to quit.")
+    print("\nSystem ready. Type 'exit' to quit, 'refresh' to reload the schema.")
     print("\nExample questions:")
     print("  - Which bot won the most matches?")
     print("  - What is the average match duration?")
@@ -184,8 +267,12 @@ def main():
                 continue
             if question.lower() in ['exit', 'quit', 'q']:
                 break
+            if question.lower() == 'refresh':
+                schema = load_schema(engine)
+                print("Schema reloaded.")
+                continue
             
-            response = run_query_pipeline(db, llm, question)
+            response = await run_query_pipeline(engine, client, schema, question)
             
             print(f"\n>> Answer: {response}")
             
@@ -196,4 +283,4 @@ def main():
             print(f"\nError processing query: {e}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,53 +1,53 @@
+import asyncio
 import os
+import sys
 import time
 import duckdb
-from langchain_ollama import OllamaLLM
+from ollama import AsyncClient
+from llm_common import (
+    OLLAMA_HOST, VERBOSE, answer_options, build_answer_prompt, build_followup_answer_prompt, build_sql_prompt,
+    build_sql_system, clean_sql, format_timings, generate, generate_sql, put_cached_sql, scalar_answer, sql_cache_key, warm_up,
+)
+from nl_sql_common import DUCKDB_CONFIG, SCHEMA_LABEL, format_schema, is_safe_readonly, quote_ident, run_sql
 
 # Configuration
 DB_FILE = "sample_game.duckdb"
 SQLITE_FILE = "sample_game.sqlite"
 MODEL_NAME = "duckdb-nsql:7b"  # Can be changed to other models
+ANSWER_MODEL_NAME = "gemma3:4b"  # Writes the answer when MODEL_NAME is SQL-only
+# SQL-specialized models (duckdb-nsql, sqlcoder) can only write SQL, in their own prompt format
+SQL_ONLY_MODEL = "duckdb-nsql" in MODEL_NAME.lower() or "sqlcoder" in MODEL_NAME.lower()
+# Chat models answer in JSON-constrained form; SQL-only models complete the "SELECT" prompt as text
+STRUCTURED_SQL = not SQL_ONLY_MODEL
+# Two models stay loaded when the answer step uses a general-purpose model,
+# so start the server with OLLAMA_MAX_LOADED_MODELS=2 (see llm_common.OLLAMA_HOST).
+
+DATABASE_CONTEXT = """Database Context:
+- matches: one row per match between two bots; a match has many rounds, a round has many events
+- To count unique bots in matches, UNION left_bot_id, right_bot_id and winner_bot_id
 
-def _format_schema(con: duckdb.DuckDBPyConnection) -> str:
+Important SQL Rules:
+- Avoid redundant JOINs or self-joins without proper aliases
+- Prefer subqueries or CTEs for clarity when needed"""
+
+
+def _format_ddl(con: duckdb.DuckDBPyConnection) -> str:
     """
-    Build a compact schema string for the LLM prompt (DuckDB).
+    Raw CREATE TABLE statements, as SQL-specialized models (duckdb-nsql, sqlcoder) were trained on.
     """
-    try:
-        tables = [r[0] for r in con.execute("SHOW TABLES").fetchall()]
-    except Exception:
-        # Fallback via information_schema
-        tables = [r[0] for r in con.execute(
-            "SELECT table_name FROM information_schema.tables WHERE table_schema='main'"
-        ).fetchall()]
-
-    if not tables:
+    rows = con.execute("SELECT sql FROM duckdb_tables() WHERE schema_name = 'main' ORDER BY table_name").fetchall()
+    if not rows:
         return "(No tables found.)"
+    return "\n".join(r[0] for r in rows)
 
-    parts = []
-    for t in tables:
-        try:
-            # PRAGMA table_info returns: cid, name, type, notnull, dflt_value, pk
-            cols = con.execute(f"PRAGMA table_info('{t}')").fetchall()
-        except Exception as e:
-            parts.append(f"Table {t}: <error reading columns: {e}>")
-            continue
 
-        col_lines = []
-        for _, name, coltype, notnull, dflt, pk in cols:
-            extras = []
-            if pk:
-                extras.append("PK")
-            if notnull:
-                extras.append("NOT NULL")
-            if dflt is not None:
-                extras.append(f"DEFAULT {dflt}")
-            extra_str = (" " + " ".join(extras)) if extras else ""
-            col_lines.append(f"  {name} {coltype}{extra_str}")
-        parts.append(f"Table {t}(\n" + ",\n".join(col_lines) + "\n)")
-    return "\n\n".join(parts)
-
-
-def get_engine():
+def _load_schema(con: duckdb.DuckDBPyConnection) -> str:
+    if SQL_ONLY_MODEL:
+        return _format_ddl(con)
+    return format_schema(con)
+
+
+async def get_engine():
     """
     Initializes the DuckDB connection and the local LLM (Ollama).
     If DuckDB file doesn't exist but SQLite does, import it.
@@ -55,206 +55,290 @@ def get_engine():
     if not os.path.exists(DB_FILE):
         if os.path.exists(SQLITE_FILE):
             print(f"Creating {DB_FILE} from {SQLITE_FILE}...")
-            con = duckdb.connect(DB_FILE)
+            # Only the import writes; the session below gets a read-only connection
+            con = duckdb.connect(DB_FILE, config=DUCKDB_CONFIG)
             # Import all tables from SQLite
-            con.execute(f"ATTACH '{SQLITE_FILE}' AS sqlite_db (TYPE SQLITE)")
+            sqlite_path = SQLITE_FILE.replace("'", "''")
+            con.execute(f"ATTACH '{sqlite_path}' AS sqlite_db (TYPE SQLITE)")
             
-            # Get table names from SQLite
-            tables = [r[0] for r in con.execute("SELECT name FROM sqlite_db.sqlite_master WHERE type='table'").fetchall()]
+            # Get table names from SQLite (the attached catalog doesn't expose sqlite_master)
+            tables = [r[0] for r in con.execute(
+                "SELECT table_name FROM duckdb_tables() WHERE database_name = 'sqlite_db'"
+            ).fetchall()]
             
-            for table in tables:
-                print(f"  Importing table: {table}")
-                con.execute(f"CREATE TABLE {table} AS SELECT * FROM sqlite_db.{table}")
+            # One transaction for all tables: a single commit/checkpoint instead of one per table
+            con.execute("BEGIN")
+            try:
+                for table in tables:
+                    print(f"  Importing table: {table}")
+                    quoted = quote_ident(table)
+                    con.execute(f"CREATE TABLE {quoted} AS SELECT * FROM sqlite_db.{quoted}")
+                con.execute("COMMIT")
+            except Exception:
+                # Don't leave a half-imported file behind that would be reused on the next run
+                con.execute("ROLLBACK")
+                con.close()
+                os.remove(DB_FILE)
+                raise
             
             con.execute("DETACH sqlite_db")
+            con.close()
             print(f"Import complete!")
         else:
             raise FileNotFoundError(
                 f"Neither {DB_FILE} nor {SQLITE_FILE} found. Please ensure sample_game.sqlite exists."
             )
-    else:
-        con = duckdb.connect(DB_FILE, read_only=False)
 
-    print(f"Connecting to local LLM via Ollama (model: {MODEL_NAME})...")
-    llm = OllamaLLM(model=MODEL_NAME, temperature=0, base_url="http://127.0.0.1:11434")
+    # Generated SQL is restricted to reads (is_safe_readonly), so skip the write/WAL machinery.
+    # is_safe_readonly only checks the first statement; read-only also rejects a write chained after it.
+    con = duckdb.connect(DB_FILE, read_only=True, config=DUCKDB_CONFIG)
 
-    return con, llm
+    print(f"Connecting to local LLM via Ollama (model: {MODEL_NAME})...")
+    client = AsyncClient(host=OLLAMA_HOST)
 
+    # SQL-specialized models can't generate conversational text, use a general model for answers
+    if SQL_ONLY_MODEL:
+        answer_model = ANSWER_MODEL_NAME
+        print(f"Using general-purpose model for natural language answers ({answer_model})...")
+    else:
+        answer_model = MODEL_NAME
 
-def _clean_sql(sql_text: str) -> str:
-    sql_query = (sql_text or "").strip()
-    if "```" in sql_query:
-        parts = sql_query.split("```")
-        if len(parts) >= 2:
-            sql_query = parts[1].strip()
-            if sql_query.lower().startswith("sql"):
-                sql_query = sql_query[3:].strip()
-    return sql_query.strip().rstrip(";")
+    try:
+        await warm_up(client, MODEL_NAME, answer_model)
+    except Exception as e:
+        print(f"Error connecting to Ollama: {e}")
+        raise
 
+    # The schema is static for the session, so build the prompt string once here
+    schema = _load_schema(con)
 
-def _is_safe_readonly(sql_query: str) -> bool:
-    """
-    Optional guardrail: allow only read-only queries by default.
-    """
-    import re
-    q = (sql_query or "").strip().lower()
-    # Normalize whitespace to handle multiline queries
-    q = re.sub(r'\s+', ' ', q)
-    # Allow WITH ... SELECT ...
-    if q.startswith("with "):
-        return True
-    return q.startswith("select ") or q.startswith("show ") or q.startswith("describe ") or q.startswith("pragma ")
+    return con, client, answer_model, schema
 
 
-def run_query_pipeline(con: duckdb.DuckDBPyConnection, llm, question: str) -> str:
-    """
-    Text -> DuckDB SQL -> Result -> Text
-    """
-    schema = _format_schema(con)
+def _build_sql_system(schema: str) -> str:
+    # Use different prompt format for SQL-specialized models
+    if SQL_ONLY_MODEL:
+        return f"""### Database Schema
+{schema}"""
+    return build_sql_system(schema, "DuckDB SQL", DATABASE_CONTEXT, SCHEMA_LABEL)
 
-    t_start_total = time.time()
 
-    # 1) Generate DuckDB SQL
-    # Use different prompt format for SQL-specialized models
-    if "duckdb-nsql" in MODEL_NAME.lower() or "sqlcoder" in MODEL_NAME.lower():
-        sql_prompt = f"""### Task
+def _build_sql_prompt(question: str) -> str:
+    if SQL_ONLY_MODEL:
+        return f"""### Task
 Generate a DuckDB SQL query to answer the following question: {question}
 
-### Database Schema
-{schema}
-
 ### SQL Query
 SELECT"""
-    else:
-        sql_prompt = f"""You are an expert SQL data analyst.
-Given the following database schema, write a DuckDB SQL query to answer the user's question.
-Return ONLY the SQL query. Do not include markdown formatting like ```sql.
+    return build_sql_prompt(question)
 
-Schema:
-{schema}
 
-Database Context:
-- bots: Contains bot information (bot_id, name, language, author, created_at)
-- matches: Contains match records between two bots (left_bot_id, right_bot_id, winner_bot_id, duration_s)
-  * To count unique bots in matches, use UNION to combine left_bot_id, right_bot_id, and winner_bot_id
-- rounds: Contains round-level data for each match (each match can have multiple rounds)
-- events: Contains detailed game events (actions, positions, states) for each round
+def _prepare_sql(sql_response: str) -> str:
+    sql_query = clean_sql(sql_response)
 
-Important SQL Rules:
-- Write clean, efficient queries
-- Avoid redundant JOINs or self-joins without proper aliases
-- Use UNION to combine columns from the same table when counting distinct values across multiple columns
-- Prefer subqueries or CTEs for clarity when needed
-
-Question: {question}
-SQL Query:"""
-
-    print("Thinking (Generating SQL)...")
-    t1_start = time.time()
-    try:
-        sql_response = llm.invoke(sql_prompt)
-    except Exception as e:
-        return f"Error communicating with Ollama: {e}\nEnsure Ollama is running."
-    t1_end = time.time()
-
-    sql_query = _clean_sql(sql_response)
-    
     # For SQL-specialized models, prepend SELECT if it's missing
-    if "duckdb-nsql" in MODEL_NAME.lower() or "sqlcoder" in MODEL_NAME.lower():
+    if SQL_ONLY_MODEL:
         if sql_query and not sql_query.upper().startswith("SELECT"):
             sql_query = "SELECT " + sql_query
+    return sql_query
 
-    print(f">> Generated SQL: {sql_query}")
-    print(f"   (SQL Gen Time: {(t1_end - t1_start) * 1000:.2f} ms)")
 
+def _execute_sql(con: duckdb.DuckDBPyConnection, sql_query: str, sql_response: str):
+    """
+    Validate and run the generated SQL.
+    Returns (error, raw_result, scalar, row_count); on failure only error is set, see run_sql for the rest.
+    """
     if not sql_query:
         print(f">> WARNING: LLM returned empty/invalid response")
         print(f">> Raw LLM Response: {repr(sql_response)}")
-        return f"Error: LLM returned an empty SQL query. Raw response: {repr(sql_response)[:200]}"
+        return f"Error: LLM returned an empty SQL query. Raw response: {repr(sql_response)[:200]}", None, None, None
 
     # Optional safety: block non-read-only queries
-    if not _is_safe_readonly(sql_query):
+    if not is_safe_readonly(sql_query):
         return (
             "Blocked a non-read-only query for safety.\n"
             f"Generated query was: {sql_query}\n"
-            "If you want to allow writes/DDL, edit _is_safe_readonly()."
-        )
+            "If you want to allow writes/DDL, edit is_safe_readonly() in nl_sql_common.py."
+        ), None, None, None
 
-    # 2) Execute against DuckDB
     try:
-        print("Executing...")
-        t2_start = time.time()
+        return None, *run_sql(con, sql_query)
+    except Exception as e:
+        return f"Error executing DuckDB SQL: {e}", None, None, None
 
-        # Prefer a dataframe result for nicer display (requires pandas)
-        result_obj = None
-        try:
-            result_obj = con.execute(sql_query).fetchdf()
-        except Exception:
-            result_obj = con.execute(sql_query).fetchall()
 
-        t2_end = time.time()
-        print(f"   (DB Exec Time: {(t2_end - t2_start) * 1000:.2f} ms)")
-    except Exception as e:
-        return f"Error executing DuckDB SQL: {e}"
+async def run_query_pipeline(
+    con: duckdb.DuckDBPyConnection, client: AsyncClient, answer_model: str, schema: str, question: str
+) -> str:
+    """
+    Text -> DuckDB SQL -> Result -> Text
+    """
+    t_start_total = time.perf_counter_ns()
+    timings = {}
 
-    # Prepare raw result string for LLM answer
-    if hasattr(result_obj, "to_string"):
-        # pandas DataFrame
-        raw_result = result_obj.head(50).to_string(index=False)
-    else:
-        raw_result = str(result_obj[:50]) if isinstance(result_obj, list) else str(result_obj)
+    # 1) Generate DuckDB SQL
+    sql_prompt = _build_sql_prompt(question)
 
-    # 3) Natural language answer
-    # SQL-specialized models can't generate conversational text, use a general model
-    if "duckdb-nsql" in MODEL_NAME.lower() or "sqlcoder" in MODEL_NAME.lower():
-        print("Using general-purpose model for natural language answer...")
-        answer_llm = OllamaLLM(model="gemma3:4b", temperature=0, base_url="http://127.0.0.1:11434")
-    else:
-        answer_llm = llm
-    
-    answer_prompt = f"""You are a helpful data assistant.
-        Based on the user's question, the SQL query used, and the raw result, write a natural language answer.
-        Do not repeat the SQL query. Just give the answer in a clear sentence.
+    if VERBOSE:
+        print("Thinking (Generating SQL)...")
+    t1_start = time.perf_counter_ns()
+    try:
+        cache_key = sql_cache_key(MODEL_NAME, question, schema)
+        sql_response, context, cached = await generate_sql(client, MODEL_NAME, _build_sql_system(schema), sql_prompt, cache_key, structured=STRUCTURED_SQL)
+    except Exception as e:
+        return f"Error communicating with Ollama: {e}\nEnsure Ollama is running."
+    t1_end = time.perf_counter_ns()
 
-        Question: {question}
-        SQL Query: {sql_query}
-        Raw Result: {raw_result}
+    sql_query = _prepare_sql(sql_response)
+    if answer_model != MODEL_NAME:
+        # The SQL step's context is only valid for the model that produced it
+        context = None
 
-        Answer (in a natural, conversational sentence):"""
+    print(f">> Generated SQL: {sql_query}")
+    timings["sql"] = t1_end - t1_start
+
+    # 2) Execute against DuckDB
+    if VERBOSE:
+        print("Executing...")
+    t2_start = time.perf_counter_ns()
+    error, raw_result, scalar, row_count = _execute_sql(con, sql_query, sql_response)
+    t2_end = time.perf_counter_ns()
+    if error:
+        return error
+    timings["db"] = t2_end - t2_start
+    # Stored outside the db timing: the cache commit costs more than most DuckDB queries
+    if not cached:
+        put_cached_sql(cache_key, sql_query)
+
+    # 3) Natural language answer (a single value is phrased directly)
+    if scalar is not None:
+        timings["total"] = t2_end - t_start_total
+        print(format_timings(timings))
+        return scalar_answer(question, scalar)
+
+    # With the SQL step's context, the question and SQL are already known to the model
+    if context:
+        answer_prompt = build_followup_answer_prompt(raw_result)
+    else:
+        answer_prompt = build_answer_prompt(question, sql_query, raw_result)
 
-    print("Formulating answer...")
-    t3_start = time.time()
-    final_answer = answer_llm.invoke(answer_prompt)
-    t3_end = time.time()
-    print(f"   (Answer Gen Time: {(t3_end - t3_start) * 1000:.2f} ms)")
+    if VERBOSE:
+        print("Formulating answer...")
+    t3_start = time.perf_counter_ns()
+    final_answer = await generate(client, answer_model, answer_prompt, options=answer_options(row_count), context=context)
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t3_start
 
-    t_end_total = time.time()
-    print(f"   [Total Time: {(t_end_total - t_start_total) * 1000:.2f} ms]")
+    t_end_total = time.perf_counter_ns()
+    timings["total"] = t_end_total - t_start_total
+    print(format_timings(timings))
 
     return final_answer
 
 
-def main():
+async def run_batch(
+    con: duckdb.DuckDBPyConnection, client: AsyncClient, answer_model: str, schema: str, questions: list[str]
+) -> list[str]:
+    """
+    Runs the pipeline for several questions at once.
+    Both LLM stages are sent concurrently across the batch; SQL runs sequentially on the shared connection.
+    """
+    t_start_total = time.perf_counter_ns()
+    timings = {}
+
+    if VERBOSE:
+        print(f"Thinking (Generating SQL for {len(questions)} questions)...")
+    cache_keys = [sql_cache_key(MODEL_NAME, q, schema) for q in questions]
+    sql_system = _build_sql_system(schema)
+    sql_responses = await asyncio.gather(
+        *[generate_sql(client, MODEL_NAME, sql_system, _build_sql_prompt(q), key, structured=STRUCTURED_SQL)
+          for q, key in zip(questions, cache_keys)],
+        return_exceptions=True,
+    )
+    t1_end = time.perf_counter_ns()
+    timings["sql"] = t1_end - t_start_total
+
+    answers = [None] * len(questions)
+    pending = []  # (index, answer_prompt, options, context)
+    new_sql = []  # (cache_key, sql_query), stored once the stages are timed
+    for i, (question, sql_response) in enumerate(zip(questions, sql_responses)):
+        if isinstance(sql_response, Exception):
+            answers[i] = f"Error communicating with Ollama: {sql_response}"
+            continue
+        sql_response, context, cached = sql_response
+        sql_query = _prepare_sql(sql_response)
+        error, raw_result, scalar, row_count = _execute_sql(con, sql_query, sql_response)
+        if error:
+            answers[i] = error
+            continue
+        if not cached:
+            new_sql.append((cache_keys[i], sql_query))
+        if scalar is not None:
+            answers[i] = scalar_answer(question, scalar)
+            continue
+        if context and answer_model == MODEL_NAME:
+            answer_prompt = build_followup_answer_prompt(raw_result)
+        else:
+            answer_prompt, context = build_answer_prompt(question, sql_query, raw_result), None
+        pending.append((i, answer_prompt, answer_options(row_count), context))
+    t2_end = time.perf_counter_ns()
+    timings["db"] = t2_end - t1_end
+
+    if VERBOSE:
+        print("Formulating answers...")
+    final_answers = await asyncio.gather(
+        *[generate(client, answer_model, prompt, options=options, context=context) for _, prompt, options, context in pending],
+        return_exceptions=True,
+    )
+    for (i, *_), final_answer in zip(pending, final_answers):
+        answers[i] = f"Error communicating with Ollama: {final_answer}" if isinstance(final_answer, Exception) else final_answer
+    t3_end = time.perf_counter_ns()
+    timings["ans"] = t3_end - t2_end
+    timings["total"] = t3_end - t_start_total
+    print(format_timings(timings))
+
+    for cache_key, sql_query in new_sql:
+        put_cached_sql(cache_key, sql_query)
+    return answers
+
+
+async def main():
     print("==========================================")
     print("   Sumobot Sample Game Query Interface (DuckDB)")
     print("==========================================")
     print(f"Using Database: {DB_FILE}")
     print(f"Using Model:    {MODEL_NAME} (via Ollama)")
     print("------------------------------------------")
-    print("\nDatabase contains:")
-    print("  - 30 bots (with names, languages, authors)")
-    print("  - 50 matches (left vs right bot battles)")
-    print("  - 123 rounds (multiple rounds per match)")
-    print("  - 1700 events (detailed game actions/positions)")
-    print("------------------------------------------")
 
     try:
-        con, llm = get_engine()
+        con, client, answer_model, schema = await get_engine()
     except Exception as e:
         print(f"Initialization failed: {e}")
         return
 
-    print("\nSystem ready. Type 'exit' to quit.")
+    # Row counts come from the catalog statistics, so no table is scanned
+    try:
+        table_counts = dict(con.execute("SELECT table_name, estimated_size FROM duckdb_tables()").fetchall())
+    except Exception:
+        table_counts = {}
+
+    print("\nDatabase contains:")
+    print(f"  - {table_counts.get('bots', '?')} bots (with names, languages, authors)")
+    print(f"  - {table_counts.get('matches', '?')} matches (left vs right bot battles)")
+    print(f"  - {table_counts.get('rounds', '?')} rounds (multiple rounds per match)")
+    print(f"  - {table_counts.get('events', '?')} events (detailed game actions/positions)")
+    print("------------------------------------------")
+
+    # Questions passed on the command line are answered as one concurrent batch
+    if len(sys.argv) > 1:
+        questions = sys.argv[1:]
+        answers = await run_batch(con, client, answer_model, schema, questions)
+        for question, answer in zip(questions, answers):
+            print(f"\n>> Question: {question}\n>> Answer: {answer}")
+        con.close()
+        return
+
+    print("\nSystem ready. Type 'exit' to quit, 'refresh' to reload the schema and clear cached results.")
     print("\nExample questions:")
     print("  - Which bot won the most matches?")
     print("  - What is the average match duration?")
@@ -269,8 +353,13 @@ def main():
                 continue
             if question.lower() in ["exit", "quit", "q"]:
                 break
+            if question.lower() == "refresh":
+                schema = _load_schema(con)
+                run_sql.cache_clear()
+                print("Schema reloaded.")
+                continue
 
-            response = run_query_pipeline(con, llm, question)
+            response = await run_query_pipeline(con, client, answer_model, schema, question)
             print(f"\n>> Answer: {response}")
 
         except KeyboardInterrupt:
@@ -286,4 +375,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
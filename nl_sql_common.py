@@ -0,0 +1,115 @@
+"""
+Shared DuckDB pieces of the natural-language query interfaces
+(natural_query_duckdb.py and natural_query_sample_duckdb.py):
+schema formatting, the read-only guardrail, and query execution.
+The engine-independent Ollama, prompt and answer helpers are in llm_common.py.
+"""
+import os
+import re
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+import duckdb
+
+# Connection settings: use every core for DuckDB's parallel operators and cap its buffer pool
+DUCKDB_CONFIG = {"threads": str(os.cpu_count() or 1), "memory_limit": "4GB", "enable_object_cache": "true"}
+
+_WS_RE = re.compile(r"\s+")
+# Statements that only read; "with " covers WITH ... SELECT ...
+_RO_PREFIXES = ("select ", "with ", "show ", "describe ", "pragma ")
+
+# Shorter spellings of common column types for the schema prompt (all valid DuckDB aliases)
+_TYPE_ALIASES = {"INTEGER": "INT", "VARCHAR": "TEXT", "BOOLEAN": "BOOL"}
+
+_SCHEMA_COLUMNS_SQL = """
+SELECT c.table_name, c.column_name, c.data_type, c.is_nullable = 'NO', pk.column_name IS NOT NULL
+FROM information_schema.columns c
+LEFT JOIN (
+    SELECT k.table_name, k.column_name
+    FROM information_schema.key_column_usage k
+    JOIN information_schema.table_constraints tc
+      ON tc.table_name = k.table_name AND tc.constraint_name = k.constraint_name
+    WHERE tc.constraint_type = 'PRIMARY KEY'
+) pk ON pk.table_name = c.table_name AND pk.column_name = c.column_name
+WHERE c.table_schema = 'main'
+  AND c.table_name <> '_meta'  -- load bookkeeping written by the setup scripts, not data
+ORDER BY c.table_name, c.ordinal_position
+"""
+
+
+# Heading for format_schema's output in the SQL prompt (llm_common.build_sql_system's schema_label)
+SCHEMA_LABEL = "Schema (table(column:TYPE), ! = NOT NULL, pk = primary key)"
+
+
+def format_schema(con: duckdb.DuckDBPyConnection) -> str:
+    """
+    Build a compact schema string for the LLM prompt (DuckDB).
+    One line per table: t(col:TYPE! pk, ...) where '!' marks NOT NULL. Defaults are dropped.
+    """
+    # A single catalog scan instead of one PRAGMA table_info per table
+    rows = con.execute(_SCHEMA_COLUMNS_SQL).fetchall()
+    if not rows:
+        return "(No tables found.)"
+
+    parts = []
+    for t, cols in groupby(rows, key=itemgetter(0)):
+        col_parts = []
+        for _, name, coltype, notnull, pk in cols:
+            col = f"{name}:{_TYPE_ALIASES.get(coltype, coltype)}"
+            if notnull:
+                col += "!"
+            if pk:
+                col += " pk"
+            col_parts.append(col)
+        parts.append(f"{t}(" + ", ".join(col_parts) + ")")
+    return "\n".join(parts)
+
+
+def quote_ident(name: str) -> str:
+    """
+    Quote a table or column name for interpolation into SQL ("a""b" for a"b).
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def is_safe_readonly(sql_query: str) -> bool:
+    """
+    Optional guardrail: allow only read-only queries by default.
+    You can loosen this if you want to support CREATE VIEW, etc.
+    """
+    # Normalize whitespace to handle multiline queries
+    q = _WS_RE.sub(" ", (sql_query or "").strip().lower())
+    return q.startswith(_RO_PREFIXES)
+
+
+# Rows of a result shown to the LLM
+RESULT_ROWS = 50
+
+
+def format_rows(columns: list[str], rows: list[tuple]) -> str:
+    """
+    Render rows as a plain text table: a header line, then one right-aligned line per row.
+    """
+    cells = [columns] + [[str(v) for v in row] for row in rows]
+    widths = [max(len(r[i]) for r in cells) for i in range(len(columns))]
+    return "\n".join(" ".join(v.rjust(w) for v, w in zip(r, widths)) for r in cells)
+
+
+@lru_cache(maxsize=256)
+def run_sql(con: duckdb.DuckDBPyConnection, sql_query: str):
+    """
+    Execute a query and render its first RESULT_ROWS rows for the LLM.
+    Returns (raw_result, scalar, row_count); scalar is the value of a 1 row x 1 column result, else None,
+    and row_count counts the rendered rows.
+    Cached on the exact SQL text: only read-only queries get here, so a repeated
+    question is a dict lookup. Errors are not cached. Cleared by 'refresh'.
+    """
+    # Fetch only the rows that are shown and format them directly; building a
+    # DataFrame just to print it costs more than the query itself for small results.
+    cursor = con.execute(sql_query)
+    rows = cursor.fetchmany(RESULT_ROWS)
+    columns = [d[0] for d in cursor.description]
+    scalar = rows[0][0] if len(rows) == 1 and len(columns) == 1 else None
+    return format_rows(columns, rows), scalar, len(rows)
+
+
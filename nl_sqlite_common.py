@@ -0,0 +1,53 @@
+"""
+Shared SQLite pieces of the natural-language query interfaces
+(natural_query.py and natural_query_sample.py): the engine setup, the schema prompt and query execution.
+The engine-independent Ollama and prompt helpers are in llm_common.py.
+"""
+from langchain_community.utilities import SQLDatabase
+from langchain_community.utilities.sql_database import truncate_word
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import Engine
+
+# Bytes of the database file SQLite reads through a memory map (256 MB)
+MMAP_SIZE = 268435456
+# Text values longer than this are cut for the LLM (SQLDatabase.run()'s max_string_length default)
+MAX_STRING_LENGTH = 300
+
+
+def sqlite_engine(path: str) -> Engine:
+    """
+    SQLAlchemy engine for a SQLite file, memory-mapped on every connection:
+    page reads become memory accesses instead of read() calls.
+    """
+    engine = create_engine(f"sqlite:///{path}")
+    event.listen(engine, "connect", lambda dbapi_conn, _: dbapi_conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}"))
+    return engine
+
+
+def load_schema(engine: Engine) -> str:
+    """
+    Table descriptions (with sample rows) for the SQL prompt.
+    SQLDatabase reflects the table list once, when it is built, so a new one is built on every call
+    and a 'refresh' picks up added tables and columns.
+    """
+    # _meta is setup_database.py's load bookkeeping, not data (SQLDatabase rejects names that don't exist)
+    ignore_tables = [t for t in inspect(engine).get_table_names() if t == "_meta"]
+    return SQLDatabase(engine, ignore_tables=ignore_tables).get_table_info()
+
+
+def run_sql(engine: Engine, sql_query: str):
+    """
+    Execute a query and render the result as SQLDatabase.run() does: str() of the list of row tuples,
+    "" when there are none, text values cut to MAX_STRING_LENGTH characters.
+    Returns (raw_result, scalar, row_count); scalar is the value of a 1 row x 1 column result, else None.
+    The rows are read before the connection is released, so the result never outlives its connection
+    whatever pool the SQLAlchemy version uses.
+    """
+    # A transaction that commits on exit, as SQLDatabase.run() runs statements (1.4 and 2.x alike)
+    with engine.begin() as conn:
+        result = conn.execute(text(sql_query))
+        if not result.returns_rows:
+            return "", None, 0
+        rows = [tuple(truncate_word(v, length=MAX_STRING_LENGTH) for v in row) for row in result]
+        scalar = rows[0][0] if len(rows) == 1 and len(result.keys()) == 1 else None
+    return (str(rows) if rows else ""), scalar, len(rows)
@@ -0,0 +1,66 @@
+"""
+Builds both databases (sumobot.db for SQLite, sumobot.duckdb for DuckDB) from a single parse of the CSV.
+Needs pyarrow; without it, run setup_database.py and setup_database_duckdb.py separately.
+"""
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+
+import setup_database
+import setup_database_duckdb
+from setup_common import file_hash, load_arrow
+
+CSV_FILE = setup_database.CSV_FILE
+# RAM-backed on Linux, so the Arrow IPC hand-off between processes never touches the disk
+IPC_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _read_ipc(path):
+    """Memory-maps an Arrow IPC file; the returned table's columns point into the mapping (no copy)."""
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def _setup_sqlite(path):
+    setup_database.setup_database(_read_ipc(path))
+
+
+def _setup_duckdb(path):
+    setup_database_duckdb.setup_database(_read_ipc(path))
+
+
+def setup_all():
+    if not os.path.exists(CSV_FILE):
+        print(f"Error: {CSV_FILE} not found. Please ensure the file is in the current directory.")
+        return
+
+    # Only databases not yet loaded from this exact CSV need the parse
+    csv_hash = file_hash(CSV_FILE)
+    loaders = [
+        loader for module, loader in ((setup_database, _setup_sqlite), (setup_database_duckdb, _setup_duckdb))
+        if module.stored_hash() != csv_hash
+    ]
+    if not loaders:
+        print(f"{CSV_FILE} is unchanged since the last load of both databases; nothing to do.")
+        return
+
+    print(f"Parsing {CSV_FILE}...")
+    table = load_arrow(CSV_FILE)
+
+    # The two loads write different files, so they run side by side in their own processes.
+    # Both read the one parsed table from an Arrow IPC file instead of each receiving a pickled copy.
+    fd, path = tempfile.mkstemp(suffix='.arrow', dir=IPC_DIR)
+    os.close(fd)
+    try:
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        with ProcessPoolExecutor(max_workers=len(loaders)) as pool:
+            for future in [pool.submit(loader, path) for loader in loaders]:
+                future.result()
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    setup_all()
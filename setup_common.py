@@ -0,0 +1,77 @@
+"""
+Shared pieces of the database setup scripts
+(setup_database.py, setup_database_duckdb.py and setup_all.py):
+change detection for the CSV (the META_TABLE hash) and the Arrow parse both loaders can start from.
+"""
+import hashlib
+
+# Columns renamed on load: 'Name' holds the action taken, 'Action' is clearer for the LLM
+RENAMES = {'Name': 'Action'}
+# Bookkeeping table in each database: BLAKE2 digest of the CSV each table was last loaded from
+META_TABLE = '_meta'
+
+
+def file_hash(path, block_size=1 << 20):
+    """BLAKE2b digest of a file, read in blocks (a change detector, not a security check)."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+
+def quote_ident(name):
+    """Quote a table or column name for interpolation into SQL ("a""b" for a"b); SQLite and DuckDB alike."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+# The META_TABLE helpers take a sqlite3 or a DuckDB connection: both speak the same SQL here
+# (qmark parameters, INSERT OR REPLACE, DuckDB's sqlite_master view) and have commit().
+
+def read_hash(conn, table):
+    """Hash of the CSV table was last loaded from, or None if it never was. Only reads."""
+    exists = conn.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = ?", [META_TABLE]
+    ).fetchone()[0]
+    if not exists:
+        return None
+    row = conn.execute(f"SELECT hash FROM {META_TABLE} WHERE name = ?", [table]).fetchone()
+    return row[0] if row else None
+
+
+def start_load(conn, table, csv_hash):
+    """
+    False when table was already loaded from the CSV with this hash: nothing to do.
+    Otherwise the old hash is forgotten first, so a load that fails part-way is redone on the next run.
+    """
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {META_TABLE} (name TEXT PRIMARY KEY, hash TEXT)")
+    if read_hash(conn, table) == csv_hash:
+        return False
+    conn.execute(f"DELETE FROM {META_TABLE} WHERE name = ?", [table])
+    conn.commit()
+    return True
+
+
+def store_hash(conn, table, csv_hash):
+    """Records that table now holds the CSV with this hash (call once the load has completed)."""
+    conn.execute(f"INSERT OR REPLACE INTO {META_TABLE} VALUES (?, ?)", [table, csv_hash])
+    conn.commit()
+
+
+def load_arrow(csv_path):
+    """
+    Parses the CSV into a pyarrow Table with pyarrow's multi-threaded reader, columns renamed per RENAMES.
+    One parse can then be handed to both loaders, which read the same column buffers.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pv
+
+    # Empty fields are NULL in every column, strings included (as pandas and DuckDB read them)
+    table = pv.read_csv(csv_path, convert_options=pv.ConvertOptions(strings_can_be_null=True))
+    # An all-empty column has no inferable type; keep it text, as DuckDB's CSV reader does
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+    # A schema-only change: no column data is copied
+    return table.rename_columns([RENAMES.get(name, name) for name in table.column_names])
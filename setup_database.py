@@ -1,53 +1,217 @@
 import pandas as pd
 import sqlite3
 import os
+from setup_common import RENAMES, file_hash, load_arrow, quote_ident, read_hash, start_load, store_hash
+
+try:
+    import pyarrow  # noqa: F401  (enables the multi-threaded Arrow parse, see load_arrow)
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 # Config
 CSV_FILE = 'GameRecord_Short.csv'
 DB_FILE = 'sumobot.db'
 TABLE_NAME = 'game_records'
+# Rows parsed and inserted per batch; bounds memory to one chunk instead of the whole file
+CHUNK_ROWS = 50_000
+
+# Low-cardinality text columns parsed as pandas categoricals: one small code array per chunk
+# instead of a Python string object per row (C engine only, see _read_csv_chunks)
+CATEGORY_COLUMNS = ('Name', 'Category', 'Reason')
+
+# SQLite's CSV virtual table (ext/misc/csv.c, built as a loadable extension). When it can be loaded
+# the whole file is parsed and inserted in C; otherwise the chunked pandas loader below is used.
+CSV_EXTENSION = 'csv'
 
-def setup_database():
+# Larger pages than SQLite's 4 KB default: fewer pages and b-tree levels for the full-table scans
+# typical of the analytics queries. Applies to a new file, or an existing one once it is VACUUMed.
+PAGE_SIZE = 32768
+
+# SQLite column affinity by inferred pandas type (as df.to_sql maps them); everything else is TEXT
+_SQLITE_TYPES = {'integer': 'INTEGER', 'boolean': 'INTEGER', 'floating': 'REAL', 'mixed-integer-float': 'REAL'}
+
+def _create_table(conn, chunk):
     """
-    Reads the GameRecord_Short.csv and loads it into a SQLite database.
+    (Re)creates the table with column types inferred from the first chunk.
+    It stays a rowid table: no column combination is unique in the logs (WITHOUT ROWID needs a
+    PRIMARY KEY), and rows of ~50 columns are too wide for WITHOUT ROWID to pay off. Rows are
+    inserted in file order, which is GameIndex order, so each game's rows are already contiguous.
     """
-    if not os.path.exists(CSV_FILE):
-        print(f"Error: {CSV_FILE} not found. Please ensure the file is in the current directory.")
+    columns = ", ".join(
+        f'{quote_ident(name)} {_SQLITE_TYPES.get(pd.api.types.infer_dtype(chunk[name], skipna=True), "TEXT")}'
+        for name in chunk.columns
+    )
+    conn.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+    conn.execute(f"CREATE TABLE {TABLE_NAME} ({columns})")
+
+def _csv_column_expr(name, chunk_column):
+    """
+    SELECT expression turning a csv-vtab text field into what pandas would have inserted:
+    empty fields become NULL, TRUE/FALSE (any case) become 1/0; the column affinity converts numbers.
+    """
+    quoted = quote_ident(name)
+    if pd.api.types.infer_dtype(chunk_column, skipna=True) == 'boolean':
+        return f"CASE upper({quoted}) WHEN 'TRUE' THEN 1 WHEN 'FALSE' THEN 0 END"
+    return f"NULLIF({quoted}, '')"
+
+def _insert_from_text_table(conn, csv_columns, chunk, source):
+    exprs = ", ".join(_csv_column_expr(name, chunk[col]) for name, col in zip(csv_columns, chunk.columns))
+    columns = ", ".join(quote_ident(name) for name in chunk.columns)
+    with conn:
+        conn.execute(f"INSERT INTO {TABLE_NAME} ({columns}) SELECT {exprs} FROM {source}")
+
+def _load_with_csv_vtab(conn, csv_columns, chunk, source='temp.csv_import'):
+    """
+    Loads the whole CSV with one INSERT ... SELECT over SQLite's csv virtual table.
+    csv_columns are the CSV header names, matching chunk's (renamed) columns by position.
+    Returns False when the extension can't be loaded.
+    """
+    try:
+        conn.enable_load_extension(True)
+        conn.load_extension(CSV_EXTENSION)
+        conn.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError):
+        # AttributeError: this Python's sqlite3 was built without extension loading
+        return False
+    
+    csv_path = CSV_FILE.replace("'", "''")
+    conn.execute(f"CREATE VIRTUAL TABLE {source} USING csv(filename='{csv_path}', header=YES)")
+    try:
+        _insert_from_text_table(conn, csv_columns, chunk, source)
+    finally:
+        conn.execute(f"DROP TABLE {source}")
+    return True
+
+def _ingest_with_adbc(table):
+    """
+    Appends an Arrow table to TABLE_NAME through ADBC's SQLite driver, which binds the column
+    buffers in C instead of building a Python tuple per row. The table's column names must match.
+    Returns False when adbc_driver_sqlite isn't installed.
+    """
+    try:
+        import adbc_driver_sqlite.dbapi as sqlite_adbc
+    except ImportError:
+        return False
+    
+    with sqlite_adbc.connect(DB_FILE) as adbc_conn:
+        with adbc_conn.cursor() as cur:
+            cur.adbc_ingest(TABLE_NAME, table, mode='append')
+        adbc_conn.commit()
+    return True
+
+def _read_csv_chunks(table=None):
+    """
+    Yields the CSV as DataFrames of up to CHUNK_ROWS rows.
+    table is the file already parsed by load_arrow: its Arrow-backed columns (strings share one
+    contiguous buffer, integer columns with gaps stay integers) are sliced without copying.
+    Otherwise pandas' C engine reads the file chunk by chunk with categorical text columns.
+    """
+    if table is not None:
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
+        for start in range(0, len(df), CHUNK_ROWS):
+            yield df.iloc[start:start + CHUNK_ROWS]
         return
+    dtypes = {col: 'category' for col in CATEGORY_COLUMNS}
+    yield from pd.read_csv(CSV_FILE, chunksize=CHUNK_ROWS, dtype=dtypes)
 
-    print(f"Reading {CSV_FILE}...")
+def stored_hash():
+    """setup_common.read_hash for TABLE_NAME; DB_FILE is opened read-only, so a missing file stays missing."""
+    if not os.path.exists(DB_FILE):
+        return None
+    conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True)
     try:
-        df = pd.read_csv(CSV_FILE)
-        
-        # Rename 'Name' column to 'Action' for better clarity and LLM understanding
-        if 'Name' in df.columns:
-            print("Renaming column 'Name' to 'Action'...")
-            df.rename(columns={'Name': 'Action'}, inplace=True)
-            
-    except Exception as e:
-        print(f"Error reading CSV: {e}")
+        return read_hash(conn, TABLE_NAME)
+    finally:
+        conn.close()
+
+def setup_database(table=None):
+    """
+    Reads the GameRecord_Short.csv and loads it into a SQLite database.
+    table: the CSV already parsed by setup_common.load_arrow, e.g. shared with the DuckDB setup.
+    """
+    if not os.path.exists(CSV_FILE):
+        print(f"Error: {CSV_FILE} not found. Please ensure the file is in the current directory.")
         return
     
-    # Data Type Optimization (Optional but good for large files)
-    # Convert timestamps if needed, but keeping as string is often safer for simple SQL queries unless date math is needed.
-    
     print(f"Creating database {DB_FILE}...")
     try:
         conn = sqlite3.connect(DB_FILE)
+        # Must come before anything is written to a new file
+        conn.execute(f"PRAGMA page_size={PAGE_SIZE}")
+        # The database is rebuilt from the CSV on failure, so trade durability for load speed:
+        # no rollback journal, no fsync, temp b-trees in RAM and a 256 MB page cache
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-262144")
+        
+        csv_hash = file_hash(CSV_FILE)
+        if not start_load(conn, TABLE_NAME, csv_hash):
+            conn.close()
+            print(f"{CSV_FILE} is unchanged since the last load; nothing to do.")
+            return
+        # A file created with another page size keeps it until rebuilt: drop the old data so VACUUM has little to copy
+        if conn.execute("PRAGMA page_size").fetchone()[0] != PAGE_SIZE:
+            conn.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+            conn.execute("VACUUM")
+        
+        print(f"Reading {CSV_FILE} into table '{TABLE_NAME}'...")
+        # With pyarrow the whole file is parsed up front, in one multi-threaded pass
+        arrow_table = load_arrow(CSV_FILE) if table is None and HAS_PYARROW else table
+        insert_sql = None
+        for chunk in _read_csv_chunks(arrow_table):
+            csv_columns = list(chunk.columns)
+            # Rename 'Name' column to 'Action' for better clarity and LLM understanding
+            # (an Arrow table arrives already renamed by load_arrow)
+            if arrow_table is None:
+                chunk = chunk.rename(columns=RENAMES)
+            
+            if insert_sql is None:
+                # With the csv extension, the first chunk is only read for the column types
+                # (skipped when the file is already parsed into Arrow)
+                _create_table(conn, chunk)
+                if arrow_table is None and _load_with_csv_vtab(conn, csv_columns, chunk):
+                    print("Loaded through SQLite's csv extension.")
+                    break
+                if arrow_table is not None and _ingest_with_adbc(arrow_table):
+                    print("Loaded through ADBC.")
+                    break
+                columns = ", ".join(quote_ident(name) for name in chunk.columns)
+                placeholders = ", ".join("?" * len(chunk.columns))
+                insert_sql = f"INSERT INTO {TABLE_NAME} ({columns}) VALUES ({placeholders})"
+            
+            # Column-wise conversion turns numpy/Arrow values into plain Python ones in C (sqlite3 can't
+            # bind numpy ints or pd.NA), with missing values as None; zip() then yields the row tuples lazily
+            rows = zip(*(chunk[name].to_numpy(dtype=object, na_value=None).tolist() for name in chunk.columns))
+            # One transaction per chunk
+            with conn:
+                conn.executemany(insert_sql, rows)
         
-        print(f"Loading {len(df)} rows into table '{TABLE_NAME}'...")
-        # if_exists='replace' will drop the table if it exists and recreate it
-        df.to_sql(TABLE_NAME, conn, if_exists='replace', index=False)
+        row_count = conn.execute(f"SELECT count(*) FROM {TABLE_NAME}").fetchone()[0]
+        print(f"Loaded {row_count} rows into table '{TABLE_NAME}'.")
         
-        # Create indices for common lookup columns to improve query performance
+        # Create indices for common lookup columns to improve query performance.
+        # Built only after the load, and in one transaction (sqlite3 runs DDL in autocommit otherwise).
+        # Composite keys so combined filters ("actions by actor X in game Y", "games won by Z") are
+        # answered from one index, and queries touching only these columns never read the table:
+        #   (GameIndex, Actor, Action) - per-game lookups, optionally narrowed by actor/action
+        #   (GameWinner, GameIndex)    - wins per bot, distinct games won
+        #   (Actor, Action, GameIndex) - action counts per actor, across or per game
+        #   (Action)                   - action-only filters
+        # ANALYZE then records per-index statistics (sqlite_stat1) so the planner can choose between them.
         print("Creating indices...")
-        cursor = conn.cursor()
-        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_game_index ON {TABLE_NAME} (GameIndex)")
-        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_game_winner ON {TABLE_NAME} (GameWinner)")
-        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_actor ON {TABLE_NAME} (Actor)")
-        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_action ON {TABLE_NAME} (Action)")
+        conn.executescript(f"""
+            BEGIN;
+            CREATE INDEX IF NOT EXISTS idx_game_actor_action ON {TABLE_NAME} (GameIndex, Actor, Action);
+            CREATE INDEX IF NOT EXISTS idx_winner_game ON {TABLE_NAME} (GameWinner, GameIndex);
+            CREATE INDEX IF NOT EXISTS idx_actor_action_game ON {TABLE_NAME} (Actor, Action, GameIndex);
+            CREATE INDEX IF NOT EXISTS idx_action ON {TABLE_NAME} (Action);
+            ANALYZE;
+            COMMIT;
+        """)
         
-        conn.commit()
+        store_hash(conn, TABLE_NAME, csv_hash)
         conn.close()
         print("Database setup complete successfully.")
         
@@ -1,54 +1,140 @@
 import os
+import tempfile
 
 import duckdb
-import pandas as pd
+from setup_common import RENAMES, file_hash, quote_ident, read_hash, start_load, store_hash
 
 # Config
 CSV_FILE = 'GameRecord_Short.csv'
+# Columnar copy of CSV_FILE, written on the first run and again whenever the CSV's content changes
+PARQUET_FILE = 'GameRecord_Short.parquet'
 DB_FILE = 'sumobot.duckdb'  # DuckDB database file
 TABLE_NAME = 'game_records'
+# Bulk-load settings: parse on every core within a capped buffer pool, spill to the temp dir, and let
+# the parallel reader write chunks as they finish (nothing downstream depends on the CSV row order)
+LOAD_CONFIG = {
+    "threads": str(os.cpu_count() or 1),
+    "memory_limit": "4GB",
+    "preserve_insertion_order": "false",
+    "temp_directory": os.path.join(tempfile.gettempdir(), "duckdb_tmp"),
+}
+# Low-cardinality text columns stored as ENUM (dictionary-encoded: a small integer per row)
+ENUM_COLUMNS = ('Action', 'Category', 'Reason')
 
 
-def setup_database():
-    """Reads the GameRecord_Short.csv and loads it into a DuckDB database."""
+def _parquet_hash(conn):
+    """
+    Hash of the CSV that PARQUET_FILE was converted from (kept in its key-value metadata),
+    or None when the file is missing, unreadable or written without one.
+    """
+    if not os.path.exists(PARQUET_FILE):
+        return None
+    parquet_path = PARQUET_FILE.replace("'", "''")
+    try:
+        row = conn.execute(
+            f"SELECT decode(value) FROM parquet_kv_metadata('{parquet_path}') WHERE decode(key) = 'csv_hash'"
+        ).fetchone()
+    except duckdb.Error:
+        return None
+    return row[0] if row else None
+
+
+def _select_list(conn, source):
+    """
+    SELECT list loading every column of source in order, renamed per RENAMES during the scan, with
+    each ENUM_COLUMNS column cast to an ENUM of its distinct values. Enum columns that are not
+    text or entirely NULL keep their type.
+    """
+    columns = conn.execute(f"SELECT column_name, column_type FROM (DESCRIBE SELECT * FROM {source})").fetchall()
+    items = []
+    for column, column_type in columns:
+        target = RENAMES.get(column, column)
+        expr = quote_ident(column)
+        if target in ENUM_COLUMNS and column_type == 'VARCHAR':
+            values = [r[0] for r in conn.execute(
+                f'SELECT DISTINCT {expr} FROM {source} WHERE {expr} IS NOT NULL ORDER BY 1'
+            ).fetchall()]
+            if values:
+                labels = ", ".join("'" + v.replace("'", "''") + "'" for v in values)
+                expr = f"CAST({expr} AS ENUM({labels}))"
+        items.append(expr if expr == quote_ident(target) else f'{expr} AS {quote_ident(target)}')
+    return ", ".join(items)
+
+
+def stored_hash():
+    """setup_common.read_hash for TABLE_NAME; DB_FILE is opened read-only, so a missing file stays missing."""
+    if not os.path.exists(DB_FILE):
+        return None
+    with duckdb.connect(DB_FILE, read_only=True) as conn:
+        return read_hash(conn, TABLE_NAME)
+
+
+def setup_database(table=None):
+    """
+    Reads the GameRecord_Short.csv and loads it into a DuckDB database.
+    table: the CSV already parsed by setup_common.load_arrow, e.g. shared with the SQLite setup.
+    """
 
     if not os.path.exists(CSV_FILE):
         print(f"Error: {CSV_FILE} not found. Please ensure the file is in the current directory.")
         return
 
-    print(f"Reading {CSV_FILE}...")
+    print(f"Creating DuckDB database {DB_FILE}...")
     try:
-        df = pd.read_csv(CSV_FILE)
+        conn = duckdb.connect(DB_FILE, config=LOAD_CONFIG)
 
-        # Rename 'Name' column to 'Action' for better clarity and LLM understanding
-        if 'Name' in df.columns:
-            print("Renaming column 'Name' to 'Action'...")
-            df.rename(columns={'Name': 'Action'}, inplace=True)
+        csv_hash = file_hash(CSV_FILE)
+        if not start_load(conn, TABLE_NAME, csv_hash):
+            conn.close()
+            print(f"{CSV_FILE} is unchanged since the last load; nothing to do.")
+            return
 
-    except Exception as e:
-        print(f"Error reading CSV: {e}")
-        return
+        if table is not None:
+            # DuckDB scans the Arrow buffers in place, no second parse and no copy
+            print(f"Loading the parsed {CSV_FILE} into table '{TABLE_NAME}'...")
+            source = 'csv_arrow'
+            conn.register(source, table)
+        else:
+            # The CSV is parsed once into Parquet; later runs read the compressed columns directly.
+            # DuckDB's own CSV reader does the conversion, without a pandas DataFrame in between.
+            # sample_size=-1 infers the column types from the whole file, not just the first rows.
+            # The Parquet file carries the hash of the CSV it came from, so it is reused only for that exact content.
+            parquet_path = PARQUET_FILE.replace("'", "''")
+            if _parquet_hash(conn) != csv_hash:
+                print(f"Converting {CSV_FILE} to {PARQUET_FILE}...")
+                csv_path = CSV_FILE.replace("'", "''")
+                conn.execute(
+                    f"COPY (SELECT * FROM read_csv_auto('{csv_path}', sample_size=-1, header=true)) "
+                    f"TO '{parquet_path}' (FORMAT PARQUET, COMPRESSION ZSTD, KV_METADATA {{csv_hash: '{csv_hash}'}})"
+                )
 
-    print(f"Creating DuckDB database {DB_FILE}...")
-    try:
-        conn = duckdb.connect(DB_FILE)
+            print(f"Reading {PARQUET_FILE} into table '{TABLE_NAME}'...")
+            source = f"read_parquet('{parquet_path}')"
+
+        conn.execute(f"CREATE OR REPLACE TABLE {TABLE_NAME} AS SELECT {_select_list(conn, source)} FROM {source}")
 
-        print(f"Loading {len(df)} rows into table '{TABLE_NAME}'...")
-        # Fast path: register the DataFrame as a temporary view, then create table from it
-        conn.register("df_view", df)
-        conn.execute(f"CREATE OR REPLACE TABLE {TABLE_NAME} AS SELECT * FROM df_view")
-        conn.unregister("df_view")
+        row_count = conn.execute(f"SELECT count(*) FROM {TABLE_NAME}").fetchone()[0]
+        print(f"Loaded {row_count} rows into table '{TABLE_NAME}'.")
 
         # Optional: DuckDB index support depends on version/workload; safe to try and fall back.
         print("Creating indexes (optional)...")
+        # All four in one transaction, after the load, so a failure leaves no partial set behind.
+        # Same composite keys as the SQLite build: ART indexes don't cover, but a combined
+        # predicate (game + actor, winner + game) becomes one index lookup instead of a scan.
         try:
-            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_game_index ON {TABLE_NAME} (GameIndex)")
-            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_game_winner ON {TABLE_NAME} (GameWinner)")
-            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_actor ON {TABLE_NAME} (Actor)")
-            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_action ON {TABLE_NAME} (Action)")
+            conn.execute(f"""
+                BEGIN;
+                CREATE INDEX IF NOT EXISTS idx_game_actor_action ON {TABLE_NAME} (GameIndex, Actor, Action);
+                CREATE INDEX IF NOT EXISTS idx_winner_game ON {TABLE_NAME} (GameWinner, GameIndex);
+                CREATE INDEX IF NOT EXISTS idx_actor_action_game ON {TABLE_NAME} (Actor, Action, GameIndex);
+                CREATE INDEX IF NOT EXISTS idx_action ON {TABLE_NAME} (Action);
+                COMMIT;
+            """)
         except Exception as idx_e:
+            conn.execute("ROLLBACK")
             print(f"Skipping indexes (not supported or not needed): {idx_e}")
 
+        store_hash(conn, TABLE_NAME, csv_hash)
         conn.close()
         print("Database setup complete successfully.")
 